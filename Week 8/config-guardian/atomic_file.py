@@ -0,0 +1,32 @@
+# Crash-safe file writes shared by guardian and its sidecar modules.
+#
+# Data goes to a temp file next to the target, then os.replace swaps it in,
+# so a reader (or a crash) never sees a half-written file. Temp names are
+# unique per process and thread: several devices, workers or daemons may
+# write the same path at once.
+
+import os
+from contextlib import contextmanager
+from threading import get_ident
+
+
+@contextmanager
+def atomic_open(path, mode='w', **kwargs):
+    """Open a temp file for writing that replaces `path` when the block succeeds."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}-{get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def atomic_write(path, data, mode='w'):
+    with atomic_open(path, mode) as f:
+        f.write(data)
@@ -0,0 +1,393 @@
+# Benchmarks for config guardian collection paths.
+# Runs guardian against simulated devices in a throwaway git workspace,
+# so no real gear (or the real configs/ history) is touched.
+
+import argparse
+import difflib
+import glob
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import guardian
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def burn_cpu(seconds):
+    """Busy pure-Python work holding the GIL, like paramiko's key exchange."""
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        sum(i * i for i in range(500))
+
+
+class FakeConnection:
+    """
+    Stand-in for a netmiko connection: sleeps `latency` seconds per
+    round trip and serves one of the stored configs as running-config.
+    `handshake_cpu` seconds of CPU are spent on every connect.
+    """
+    latency = 0.05
+    handshake_cpu = 0.0
+    configs = []
+
+    def __init__(self, **device):
+        device.pop('sock', None)
+        self.device = device
+        self.latency = device.pop('bench_latency', self.latency)
+        time.sleep(self.latency)  # TCP connect + SSH handshake
+        burn_cpu(self.handshake_cpu)
+        index = int(device['host'].split('.')[-1]) % len(self.configs)
+        with open(self.configs[index]) as f:
+            self.config = f.read()
+        self.name = f"bench-{device['host'].replace('.', '-')}"
+        # give every simulated device its own hostname inside the config
+        hostname = guardian.parse_hostname(device['device_type'], self.config)
+        if hostname:
+            self.config = self.config.replace(hostname, self.name)
+
+    def enable(self):
+        time.sleep(self.latency)
+
+    def find_prompt(self):
+        return f"[{self.device['username']}@{self.name}] >"
+
+    def send_command(self, command, **kwargs):
+        time.sleep(self.latency)
+        commands = guardian.COMMANDS[self.device['device_type']]
+        if command == commands.get('hostname'):
+            return f"{commands['to_find']} {self.name}"
+        if command == commands.get('probe'):
+            return guardian.change_marker(self.device['device_type'], self.config) or ""
+        return self.config
+
+    def is_alive(self):
+        return True
+
+    def disconnect(self):
+        pass
+
+
+def make_devices(count, device_type="cisco_ios"):
+    return [
+        {
+            'device_type': device_type,
+            'host': f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+            'username': "bench",
+            'password': "bench",
+            'port': 22,
+        }
+        for i in range(count)
+    ]
+
+
+@contextmanager
+def workspace():
+    """Temporary git repo laid out like config-guardian, used as the cwd."""
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix="guardian-bench-")
+    try:
+        os.chdir(path)
+        subprocess.run(["git", "init", "-q"], check=True)
+        subprocess.run(["git", "config", "user.email", "bench@localhost"], check=True)
+        subprocess.run(["git", "config", "user.name", "bench"], check=True)
+        os.makedirs(guardian.CONFIG_DIR)
+        guardian.config_hashes.clear()
+        yield path
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def install_fakes(latency, handshake_cpu=0.0):
+    """Point guardian at FakeConnection (also run in every --processes worker)."""
+    FakeConnection.latency = latency
+    FakeConnection.handshake_cpu = handshake_cpu
+    FakeConnection.configs = sorted(glob.glob(os.path.join(HERE, guardian.CONFIG_DIR, "*.cfg")))
+    guardian.ConnectHandler = FakeConnection
+    guardian.open_socket = lambda device: None  # FakeConnection pays the connect itself
+
+
+@contextmanager
+def fake_devices(latency, handshake_cpu=0.0):
+    original = guardian.ConnectHandler, guardian.open_socket
+    install_fakes(latency, handshake_cpu)
+    try:
+        yield
+    finally:
+        guardian.ConnectHandler, guardian.open_socket = original
+
+
+def time_run(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+RUNNERS = {
+    "threads": guardian.run_threads,
+    "pipeline": guardian.run_pipeline,
+}
+# the asyncio engine talks SSH through asyncssh, which FakeConnection can't
+# stand in for; it is only benchmarked against the device farm
+FARM_RUNNERS = dict(RUNNERS, asyncio=guardian.run_asyncio)
+
+
+def bench_engines(args):
+    """Every engine at every concurrency on the same simulated fleet."""
+    devices = make_devices(args.devices)
+
+    print(f"{args.devices} devices, {args.latency * 1000:.0f} ms per round trip")
+    with fake_devices(args.latency):
+        for concurrency in args.concurrency:
+            for engine in args.engines:
+                with workspace():
+                    elapsed = time_run(RUNNERS[engine], devices, concurrency)
+                print(f"  {engine:<8} concurrency={concurrency:<5} {elapsed:8.2f}s "
+                      f"({args.devices / elapsed:8.1f} devices/s)")
+
+
+def seed_changed_configs(count):
+    """Commit `count` configs, then change every one of them on disk."""
+    sources = sorted(glob.glob(os.path.join(HERE, guardian.CONFIG_DIR, "*.cfg")))
+    files = []
+    for i in range(count):
+        filename = f"{guardian.CONFIG_DIR}/bench-{i}.cfg"
+        shutil.copy(sources[i % len(sources)], filename)
+        files.append(filename)
+    subprocess.run(["git", "add", guardian.CONFIG_DIR], check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "seed"], check=True)
+    for filename in files:
+        with open(filename, "a") as f:
+            f.write("! bench change\n")
+    return [(filename, os.path.basename(filename)[:-4], "bench") for filename in files]
+
+
+def bench_commits(args):
+    """Per-device add+commit vs one plumbing commit for the whole run."""
+    print(f"{args.devices} changed devices")
+
+    with workspace():
+        changes = seed_changed_configs(args.devices)
+        elapsed = time_run(
+            lambda: [guardian.commit_changes(*change) for change in changes]
+        )
+    print(f"  per-device add+commit {elapsed:8.2f}s")
+
+    with workspace():
+        changes = seed_changed_configs(args.devices)
+        elapsed = time_run(guardian.commit_batch, changes)
+    print(f"  batch plumbing commit {elapsed:8.2f}s")
+
+
+def bench_schedule(args):
+    """Inventory order vs LPT order on a fleet with a few slow devices at the end."""
+    devices = make_devices(args.devices)
+    slow = max(1, args.devices * args.slow_percent // 100)
+    for device in devices[-slow:]:
+        device['bench_latency'] = args.latency * args.slow_factor
+
+    print(f"{args.devices} devices ({slow} slow), concurrency {args.concurrency}")
+    with fake_devices(args.latency), workspace():
+        guardian.device_timings.clear()
+        # first pass only gathers timings, as a previous run would have
+        guardian.run_threads([dict(d) for d in devices], args.concurrency)
+
+        for schedule in ("inventory", "lpt"):
+            if schedule == "lpt":
+                ordered, durations = guardian.lpt_order(devices)
+            else:
+                ordered, durations = devices, guardian.expected_durations(devices)
+            predicted = guardian.predict_makespan(durations, args.concurrency)
+            elapsed = time_run(guardian.run_threads, [dict(d) for d in ordered], args.concurrency)
+            print(f"  {schedule:<9} predicted {predicted:6.2f}s  actual {elapsed:6.2f}s")
+
+
+def synthetic_config(lines, seed=0):
+    """IOS-style config of about `lines` lines, full of repeated lines like real ones."""
+    rng = random.Random(seed)
+    config = ["Building configuration...", "Current configuration : 0 bytes", "!"]
+    n = 0
+    while len(config) < lines:
+        n += 1
+        if n % 4:
+            config += [
+                f"interface GigabitEthernet{n // 48}/0/{n % 48}",
+                f" description link-{rng.randrange(10 ** 6)}",
+                " switchport mode access",
+                f" switchport access vlan {rng.randrange(1, 4000)}",
+                " no shutdown",
+                "!",
+            ]
+        else:
+            config += [f" permit tcp any host 10.{n % 256}.{n // 256 % 256}.1 eq {rng.randrange(1, 65535)}"] * 2
+    return [line + "\n" for line in config[:lines]]
+
+
+def mutate_config(config, changes, seed=1):
+    """Copy of `config` with `changes` lines edited, inserted or deleted."""
+    rng = random.Random(seed)
+    changed = list(config)
+    for _ in range(changes):
+        i = rng.randrange(len(changed))
+        kind = rng.random()
+        if kind < 0.4:
+            changed[i] = f" description changed-{rng.randrange(10 ** 6)}\n"
+        elif kind < 0.7:
+            changed[i:i] = [" shutdown\n", "!\n"]
+        else:
+            del changed[i]
+    return changed
+
+
+def bench_diff(args):
+    """difflib vs the patience diff engine on synthetic configs."""
+    for size in args.lines:
+        old = synthetic_config(size)
+        new = mutate_config(old, max(1, size * args.change_percent // 100))
+        print(f"{size} lines, {args.change_percent}% changed")
+        if size <= args.difflib_max:
+            old_clean, new_clean = guardian.clean_config_lines(old), guardian.clean_config_lines(new)
+            elapsed = time_run(lambda: '\n'.join(difflib.unified_diff(old_clean, new_clean, lineterm='')))
+            print(f"  difflib   {elapsed:8.2f}s")
+        else:
+            print(f"  difflib   skipped (over --difflib-max)")
+        elapsed = time_run(guardian.diff_config_lines, old, new, "old", "new", "cisco_ios")
+        print(f"  patience  {elapsed:8.2f}s")
+
+
+def bench_processes(args):
+    """
+    One process against --processes N, with CPU-bound handshakes. Workers
+    always run the thread pool: the pipeline engine has its own diff
+    process pool and guardian rejects it with --processes.
+    """
+    devices = make_devices(args.devices)
+    print(f"{args.devices} devices, {args.latency * 1000:.0f} ms per round trip, "
+          f"{args.handshake_cpu * 1000:.0f} ms CPU per handshake, {os.cpu_count()} CPUs, "
+          f"concurrency {args.concurrency} per process")
+    with fake_devices(args.latency, args.handshake_cpu):
+        with workspace():
+            baseline = time_run(guardian.run_threads, [dict(d) for d in devices], args.concurrency)
+        print(f"  in-process      {baseline:8.2f}s ({args.devices / baseline:7.1f} devices/s)")
+        for processes in args.processes:
+            with workspace():
+                elapsed = time_run(
+                    guardian.run_processes, [dict(d) for d in devices], processes,
+                    args.concurrency, initializer=install_fakes,
+                    initargs=(args.latency, args.handshake_cpu)
+                )
+            print(f"  processes={processes:<4} {elapsed:8.2f}s ({args.devices / elapsed:7.1f} devices/s, "
+                  f"x{baseline / elapsed:.2f})")
+
+
+@contextmanager
+def device_farm(devices, latency, failure_args=()):
+    """Run device_farm.py in its own process; yields the inventory it serves."""
+    path = os.path.join(tempfile.mkdtemp(prefix="guardian-farm-"), "farm_hosts.yaml")
+    farm = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "device_farm.py"), "--devices", str(devices),
+         "--latency", str(latency), "--inventory", path, *failure_args],
+        cwd=HERE, stdout=subprocess.PIPE, text=True
+    )
+    try:
+        # the farm prints "ready <inventory>" once every device listens
+        if not farm.stdout.readline().startswith("ready"):
+            raise RuntimeError("device farm failed to start")
+        yield path
+    finally:
+        farm.terminate()
+        farm.wait()
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def bench_farm(args):
+    """Full guardian runs (real netmiko and SSH) against the local device farm."""
+    failure_args = [
+        arg for mode in ("down", "hang", "auth", "drop")
+        for arg in (f"--{mode}-rate", str(getattr(args, f"{mode}_rate")))
+    ]
+    with device_farm(args.devices, args.latency, failure_args) as inventory:
+        devices = guardian.load_inventory(inventory)
+        print(f"{args.devices} farm devices, {args.latency * 1000:.0f} ms per round trip")
+        for concurrency in args.concurrency:
+            for engine in args.engines:
+                with workspace():
+                    guardian.take_records()
+                    elapsed = time_run(FARM_RUNNERS[engine], [dict(d) for d in devices], concurrency)
+                    outcomes = {}
+                    for record in guardian.take_records():
+                        outcomes[record['outcome']] = outcomes.get(record['outcome'], 0) + 1
+                print(f"  {engine:<8} concurrency={concurrency:<5} {elapsed:8.2f}s "
+                      f"({args.devices / elapsed:6.1f} devices/s) {outcomes}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Config guardian benchmarks.")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    engines = sub.add_parser("engines", help="Compare the collection engines at equal concurrency.")
+    engines.add_argument("--devices", type=int, default=2000)
+    engines.add_argument("--latency", type=float, default=0.05,
+                         help="Seconds per simulated round trip (default: 0.05)")
+    engines.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 500])
+    engines.add_argument("--engines", nargs="+", choices=list(RUNNERS), default=list(RUNNERS),
+                         help="Engines to compare, each run at every --concurrency (default: all)")
+    engines.set_defaults(func=bench_engines)
+
+    commits = sub.add_parser("commits", help="Compare per-device and batched git commits.")
+    commits.add_argument("--devices", type=int, default=500)
+    commits.set_defaults(func=bench_commits)
+
+    schedule = sub.add_parser("schedule", help="Compare inventory order with LPT scheduling.")
+    schedule.add_argument("--devices", type=int, default=200)
+    schedule.add_argument("--concurrency", type=int, default=guardian.DEFAULT_CONCURRENCY)
+    schedule.add_argument("--latency", type=float, default=0.01)
+    schedule.add_argument("--slow-percent", type=int, default=5)
+    schedule.add_argument("--slow-factor", type=float, default=40.0)
+    schedule.set_defaults(func=bench_schedule)
+
+    diff = sub.add_parser("diff", help="Compare difflib with the patience diff engine.")
+    diff.add_argument("--lines", type=int, nargs="+", default=[10_000, 100_000, 500_000])
+    diff.add_argument("--change-percent", type=int, default=1)
+    diff.add_argument("--difflib-max", type=int, default=100_000,
+                      help="Skip difflib above this many lines (default: 100000)")
+    diff.set_defaults(func=bench_diff)
+
+    procs = sub.add_parser("processes", help="Scale collection over worker processes (--processes).")
+    procs.add_argument("--devices", type=int, default=1000)
+    procs.add_argument("--latency", type=float, default=0.02,
+                       help="Seconds per simulated round trip (default: 0.02)")
+    procs.add_argument("--handshake-cpu", type=float, default=0.02,
+                       help="CPU seconds per simulated SSH handshake (default: 0.02)")
+    procs.add_argument("--concurrency", type=int, default=50, help="Sessions per process (default: 50)")
+    procs.add_argument("--processes", type=int, nargs="+",
+                       default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    procs.set_defaults(func=bench_processes)
+
+    farm = sub.add_parser("farm", help="Run guardian over SSH against the local device farm.")
+    farm.add_argument("--devices", type=int, default=1000)
+    farm.add_argument("--latency", type=float, default=0.02,
+                      help="Seconds the farm adds per round trip (default: 0.02)")
+    farm.add_argument("--concurrency", type=int, nargs="+", default=[guardian.DEFAULT_CONCURRENCY, 100])
+    farm.add_argument("--engines", nargs="+", choices=list(FARM_RUNNERS), default=list(FARM_RUNNERS),
+                      help="Engines to compare, each run at every --concurrency (default: all)")
+    for mode in ("down", "hang", "auth", "drop"):
+        farm.add_argument(f"--{mode}-rate", type=float, default=0.0,
+                          help=f"Fraction of farm devices that are '{mode}'")
+    farm.set_defaults(func=bench_farm)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # keep per-device log lines out of the timings
+    guardian.logger.setLevel(logging.ERROR)
+    args = parse_args()
+    args.func(args)
@@ -0,0 +1,319 @@
+# Compliance checks of the backed-up configs against a YAML rule pack.
+#
+# rules:
+#   - id: no-http-server
+#     description: HTTP management server must be off
+#     device_type: cisco_ios            # one type or a list (default: every device)
+#     severity: high                    # default: medium
+#     require: no ip http server        # line(s) that must be present
+#     forbid: '^ip http server'         # regex(es) no line may match
+#   - id: vty-ssh-only
+#     device_type: cisco_ios
+#     section: '^line vty'              # check require/forbid inside every block
+#     require: transport input ssh      # whose header matches this regex
+#     forbid: 'transport input (telnet|all)'
+#
+# Lines are compared whitespace-normalized, as in config_index. A section
+# rule passes for devices without any matching block.
+#
+# The device type comes from guardian's hash index; configs it does not
+# know are recognised by their hostname line (see SIGNATURES). A config
+# that matches no vendor gets an "unknown-device-type" violation instead of
+# silently skipping every vendor-scoped rule.
+#
+# Configs are evaluated in a process pool, each worker compiling the pack
+# once. Results are cached in compliance_cache.json by device type and
+# config hash, so unchanged (or identical) configs are never re-evaluated;
+# editing the rule pack invalidates the cache.
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+
+import yaml
+
+import atomic_file
+import config_index
+import config_tree
+from concurrency import spawn_pool
+
+CONFIG_DIR = "configs"
+HASH_INDEX_FILE = "config_hashes.json"
+CACHE_FILE = "compliance_cache.json"
+SEVERITIES = ("low", "medium", "high", "critical")
+RULE_KEYS = {"id", "description", "device_type", "severity", "section", "require", "forbid"}
+POOL_THRESHOLD = 32   # fewer configs than this are checked in-process
+UNKNOWN_TYPE = "unknown"
+
+# The line that names the device, which only its own vendor's syntax has
+SIGNATURES = {
+    'cisco_ios': re.compile(r'^hostname\s+\S+', re.MULTILINE),
+    'huawei_vrp': re.compile(r'^sysname\s+\S+', re.MULTILINE),
+    'juniper_junos': re.compile(r'^\s+host-name\s+\S+', re.MULTILINE),
+    'mikrotik_routeros': re.compile(r'^/system identity\s*$', re.MULTILINE),
+}
+
+logger = logging.getLogger("config_guardian")
+
+# Rules compiled by the worker process (set by compile_pack)
+compiled_rules = []
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+class Rule:
+    """One compiled rule of the pack."""
+
+    def __init__(self, spec):
+        if "id" not in spec:
+            raise ValueError(f"Rule without an id: {spec}")
+        unknown = set(spec) - RULE_KEYS
+        if unknown:
+            raise ValueError(f"Rule {spec['id']}: unknown keys {', '.join(sorted(unknown))}")
+        self.id = spec["id"]
+        self.description = spec.get("description", "")
+        self.device_types = set(as_list(spec.get("device_type")))
+        self.severity = spec.get("severity", "medium")
+        if self.severity not in SEVERITIES:
+            raise ValueError(f"Rule {self.id}: severity must be one of {', '.join(SEVERITIES)}")
+        self.section = re.compile(spec["section"]) if spec.get("section") else None
+        self.require = [config_index.normalize_line(line) for line in as_list(spec.get("require"))]
+        self.forbid = [re.compile(pattern) for pattern in as_list(spec.get("forbid"))]
+        if not self.require and not self.forbid:
+            raise ValueError(f"Rule {self.id} has neither 'require' nor 'forbid'")
+
+    def applies_to(self, device_type):
+        return not self.device_types or device_type in self.device_types
+
+    def violation(self, message):
+        return {'rule': self.id, 'severity': self.severity, 'message': message}
+
+    def check_lines(self, lines, where=""):
+        violations = []
+        present = set(lines)
+        for line in self.require:
+            if line not in present:
+                violations.append(self.violation(f"{where}missing '{line}'"))
+        for pattern in self.forbid:
+            for line in lines:
+                if pattern.search(line):
+                    violations.append(self.violation(f"{where}forbidden '{line}'"))
+        return violations
+
+    def check(self, lines, sections):
+        """
+        :param lines: normalized config lines
+        :param sections: [(header, [normalized lines of the block])]
+        """
+        if self.section is None:
+            return self.check_lines(lines)
+        violations = []
+        for header, body in sections:
+            if self.section.search(header):
+                violations += self.check_lines(body, f"{header}: ")
+        return violations
+
+
+def load_pack(path):
+    """Read a rule pack; returns (raw rules, digest of the file)."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    pack = yaml.safe_load(data) or {}
+    rules = pack.get("rules", []) if isinstance(pack, dict) else pack
+    compile_rules(rules)   # fail early, in the parent, on a broken pack
+    return rules, hashlib.sha256(data).hexdigest()
+
+
+def compile_rules(rules):
+    ids = [spec.get("id") for spec in rules]
+    duplicates = {rule_id for rule_id in ids if ids.count(rule_id) > 1}
+    if duplicates:
+        raise ValueError(f"Duplicate rule ids: {', '.join(sorted(map(str, duplicates)))}")
+    return [Rule(spec) for spec in rules]
+
+
+def compile_pack(rules):
+    """Pool initializer: compile the pack once per worker process."""
+    global compiled_rules
+    compiled_rules = compile_rules(rules)
+
+
+def flatten(children):
+    for text, grandchildren in children:
+        yield config_index.normalize_line(text)
+        yield from flatten(grandchildren)
+
+
+def blocks(parsed):
+    """(header, body lines) of every block in the parsed config, at any depth."""
+    for text, children in parsed:
+        if children:
+            yield config_index.normalize_line(text), list(flatten(children))
+            yield from blocks(children)
+
+
+def evaluate_config(config_file, device_type=None):
+    """
+    Violations of one config against the compiled rules. Without a device
+    type only the rules for every device are checked, and the config is
+    reported for the vendor-scoped ones it could not be checked against.
+    """
+    rules = [rule for rule in compiled_rules if rule.applies_to(device_type)]
+    violations = []
+    if device_type is None:
+        skipped = [rule.id for rule in compiled_rules if rule.device_types]
+        if skipped:
+            violations.append({
+                'rule': 'unknown-device-type', 'severity': 'medium',
+                'message': f"device type unknown, not checked against {', '.join(skipped)}",
+            })
+    if not rules:
+        return violations
+    with open(config_file, 'r', errors='replace') as f:
+        raw_lines = f.read().splitlines()
+    lines = [line for line in map(config_index.normalize_line, raw_lines) if line]
+    sections = None
+    for rule in rules:
+        if rule.section is not None and sections is None:
+            sections = list(blocks(config_tree.parse_sections(raw_lines, device_type)))
+        violations += rule.check(lines, sections)
+    return violations
+
+
+def detect_device_type(text):
+    """The vendor whose hostname line the config has, or None."""
+    for device_type, signature in SIGNATURES.items():
+        if signature.search(text):
+            return device_type
+    return None
+
+
+def device_info(config_dir, hash_index):
+    """
+    {hostname: (config file, device type, cache key)} for every stored config.
+    The normalized hash and device type guardian recorded are used while
+    the file size still matches; otherwise the file itself is hashed and
+    its device type detected.
+    """
+    known = {}
+    if os.path.exists(hash_index):
+        with open(hash_index, 'r') as f:
+            known = json.load(f)
+    devices = {}
+    for filename in sorted(os.listdir(config_dir)) if os.path.isdir(config_dir) else []:
+        if not filename.endswith(".cfg"):
+            continue
+        hostname, config_file = filename[:-4], os.path.join(config_dir, filename)
+        entry = known.get(hostname, {})
+        digest, device_type = entry.get('sha256'), entry.get('device_type')
+        if not digest or not device_type or entry.get('size') != os.path.getsize(config_file):
+            with open(config_file, 'rb') as f:
+                data = f.read()
+            if not digest or entry.get('size') != len(data):
+                digest = "raw-" + hashlib.sha256(data).hexdigest()
+            device_type = device_type or detect_device_type(data.decode(errors='replace'))
+        devices[hostname] = (config_file, device_type, f"{device_type or UNKNOWN_TYPE}:{digest}")
+    return devices
+
+
+def load_cache(path, pack_digest):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        cache = json.load(f)
+    return cache['results'] if cache.get('pack') == pack_digest else {}
+
+
+def save_cache(path, pack_digest, results):
+    with atomic_file.atomic_open(path) as f:
+        json.dump({'pack': pack_digest, 'results': results}, f)
+
+
+def evaluate(rules_file, config_dir=CONFIG_DIR, hash_index=HASH_INDEX_FILE,
+             cache_file=CACHE_FILE, processes=None):
+    """
+    Check every stored config against the rule pack.
+    Returns ({hostname: [violations]}, number of configs actually evaluated).
+    :param cache_file: None to evaluate everything without a cache
+    :param processes: worker processes (default: one per CPU)
+    """
+    rules, pack_digest = load_pack(rules_file)
+    devices = device_info(config_dir, hash_index)
+    cache = load_cache(cache_file, pack_digest)
+
+    # identical configs of the same device type are evaluated once
+    pending = {}
+    for hostname, (config_file, device_type, key) in devices.items():
+        if key not in cache:
+            pending.setdefault(key, (config_file, device_type))
+
+    if pending:
+        keys = list(pending)
+        files, types = zip(*pending.values())
+        if len(keys) < POOL_THRESHOLD or processes == 1:
+            compile_pack(rules)
+            results = list(map(evaluate_config, files, types))
+        else:
+            with spawn_pool(processes, initializer=compile_pack, initargs=(rules,)) as pool:
+                chunksize = max(1, len(keys) // ((processes or os.cpu_count() or 1) * 8))
+                results = list(pool.map(evaluate_config, files, types, chunksize=chunksize))
+        cache.update(zip(keys, results))
+
+    if cache_file:
+        # only keep the entries of configs that still exist
+        in_use = {key for _, _, key in devices.values()}
+        save_cache(cache_file, pack_digest, {key: cache[key] for key in in_use})
+    return {hostname: cache[key] for hostname, (_, _, key) in devices.items()}, len(pending)
+
+
+def summary(results):
+    failing = {hostname: violations for hostname, violations in results.items() if violations}
+    return {
+        'devices': len(results),
+        'failing': len(failing),
+        'violations': sum(len(violations) for violations in failing.values()),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check the backed-up configs against a compliance rule pack.")
+    parser.add_argument("rules", help="YAML rule pack")
+    parser.add_argument("--config-dir", default=CONFIG_DIR, help=f"Stored configs (default: {CONFIG_DIR})")
+    parser.add_argument("--hash-index", default=HASH_INDEX_FILE,
+                        help=f"Guardian hash index, for device types and hashes (default: {HASH_INDEX_FILE})")
+    parser.add_argument("--processes", type=int, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--no-cache", action="store_true", help="Re-evaluate every config")
+    parser.add_argument("--json", dest="json_file", help="Also write the results to this JSON file")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print the summary")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parse_args()
+
+    try:
+        results, evaluated = evaluate(args.rules, args.config_dir, args.hash_index,
+                                      None if args.no_cache else CACHE_FILE, args.processes)
+    except (ValueError, re.error, yaml.YAMLError) as e:
+        raise SystemExit(f"Invalid rule pack {args.rules}: {e}")
+
+    if not args.quiet:
+        for hostname, violations in results.items():
+            for violation in violations:
+                print(f"{hostname}: [{violation['severity']}] {violation['rule']}: {violation['message']}")
+    totals = summary(results)
+    logger.info("%d violations on %d of %d devices (%d configs evaluated, the rest cached)",
+                totals['violations'], totals['failing'], totals['devices'], evaluated)
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump({'summary': totals, 'results': results}, f, indent=2, sort_keys=True)
+    sys.exit(1 if totals['violations'] else 0)
@@ -0,0 +1,146 @@
+# Adaptive concurrency control for guardian runs.
+#
+# Every device belongs to two segments: its vendor (device_type) and its
+# site (inventory). Each segment has its own AIMD limit: it creeps up by
+# roughly one slot per round of healthy sessions and halves when connects
+# fail or get much slower than usual, so healthy segments speed up while
+# saturated TACACS servers or WAN links get backed off.
+#
+# It also holds the one way guardian and its sidecars start processes.
+
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Condition
+
+logger = logging.getLogger("config_guardian")
+
+SLOW_FACTOR = 3.0       # connect this many times slower than the baseline counts as congestion
+BASELINE_WEIGHT = 0.1   # EWMA weight of each new connect latency
+DECREASE_COOLDOWN = 2.0  # seconds between two halvings of the same limit
+
+# Child processes are spawned, never forked: guardian starts them with
+# logging, SSH and pool threads already running, and a forked child would
+# inherit whatever locks those threads held at that moment.
+SPAWN = multiprocessing.get_context("spawn")
+
+
+def spawn_pool(max_workers=None, **kwargs):
+    """ProcessPoolExecutor whose workers are started with SPAWN."""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=SPAWN, **kwargs)
+
+
+class AdaptiveLimit:
+    """AIMD concurrency limit for one segment of the fleet."""
+
+    def __init__(self, name, initial, maximum):
+        self.name = name
+        self.limit = float(min(initial, maximum))
+        self.maximum = maximum
+        self.in_flight = 0
+        self.baseline = None
+        self.last_decrease = 0.0
+
+    def has_room(self):
+        return self.in_flight < int(self.limit)
+
+    def observe(self, ok, latency):
+        """Adjust the limit after a session finishes (caller holds the lock)."""
+        slow = (
+            latency is not None and self.baseline is not None
+            and latency > SLOW_FACTOR * self.baseline
+        )
+        if ok and latency is not None and not slow:
+            if self.baseline is None:
+                self.baseline = latency
+            else:
+                self.baseline += BASELINE_WEIGHT * (latency - self.baseline)
+
+        now = time.monotonic()
+        if not ok or slow:
+            # multiplicative decrease, at most once per cooldown window
+            if now - self.last_decrease >= DECREASE_COOLDOWN:
+                self.limit = max(1.0, self.limit / 2)
+                self.last_decrease = now
+                logger.info(
+                    "Concurrency for %s lowered to %d (%s)",
+                    self.name, int(self.limit), "failure" if not ok else "slow connect"
+                )
+        else:
+            # additive increase: about +1 once a full window has succeeded
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+
+class ConcurrencyController:
+    """
+    Schedules devices onto a thread pool while respecting one AdaptiveLimit
+    per vendor and one per site. Devices whose segments are full wait in
+    their own queue, so a slow segment never blocks the others.
+    """
+
+    def __init__(self, vendor_limit, site_limit, maximum):
+        self.vendor_limit = vendor_limit
+        self.site_limit = site_limit
+        self.maximum = maximum
+        self.limits = {}
+        self.in_flight = 0
+        self.cond = Condition()
+
+    def limits_for(self, vendor, site):
+        for key, initial in ((f"vendor {vendor}", self.vendor_limit), (f"site {site}", self.site_limit)):
+            if key not in self.limits:
+                self.limits[key] = AdaptiveLimit(key, initial, self.maximum)
+        return [self.limits[f"vendor {vendor}"], self.limits[f"site {site}"]]
+
+    def run(self, devices, worker, segment, on_done=None):
+        """
+        Run worker(device) for every device.
+        :param worker: returns (ok, connect_latency) for one device
+        :param segment: returns (vendor, site) for a device
+        :param on_done: optional callback after each device (progress bars)
+        """
+        queues = OrderedDict()
+        for device in devices:
+            queues.setdefault(segment(device), deque()).append(device)
+
+        def run_one(device, limits):
+            ok, latency = False, None
+            try:
+                ok, latency = worker(device)
+            finally:
+                with self.cond:
+                    self.in_flight -= 1
+                    for limit in limits:
+                        limit.in_flight -= 1
+                        limit.observe(ok, latency)
+                    self.cond.notify_all()
+                if on_done:
+                    on_done()
+
+        with ThreadPoolExecutor(max_workers=self.maximum) as executor:
+            with self.cond:
+                while queues:
+                    picked = None
+                    if self.in_flight < self.maximum:
+                        for key, waiting in queues.items():
+                            limits = self.limits_for(*key)
+                            if all(limit.has_room() for limit in limits):
+                                picked = (key, waiting.popleft(), limits)
+                                break
+                    if picked is None:
+                        self.cond.wait()
+                        continue
+
+                    key, device, limits = picked
+                    if not queues[key]:
+                        del queues[key]
+                    self.in_flight += 1
+                    for limit in limits:
+                        limit.in_flight += 1
+                    executor.submit(run_one, device, limits)
+
+    def summary(self):
+        with self.cond:
+            return {name: int(limit.limit) for name, limit in sorted(self.limits.items())}
@@ -0,0 +1,213 @@
+# Line diff for large device configs.
+#
+# difflib.SequenceMatcher goes quadratic on 100k-line firewall and Junos
+# configs full of repeated lines ("!", "exit", " no shutdown"). This engine
+# turns every line into an integer once, then uses patience diff: lines
+# that occur exactly once on both sides anchor the alignment, and the gaps
+# between anchors are diffed the same way. Gaps without unique lines fall
+# back to the rarest shared line (the idea behind git's histogram diff).
+# Output is the same unified format difflib.unified_diff produces.
+
+import re
+
+# A gap whose rarest shared line occurs more often than this is treated as
+# a plain replace instead of searched further
+MAX_ANCHOR_OCCURRENCES = 64
+
+
+def noise_regex(patterns):
+    """Compile a list of noise patterns into one regex (None if there are none)."""
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+
+
+def clean_lines(lines, noise):
+    """
+    Drop the lines `noise` matches at their start, then the blank lines
+    around the config and its final line break, which differ between the
+    CLI output and a copy of the same config saved as a file.
+    """
+    if noise is None:
+        lines = list(lines)
+    else:
+        match = noise.match
+        lines = [line for line in lines if not match(line)]
+    start, end = 0, len(lines)
+    while start < end and not lines[start].strip():
+        start += 1
+    while end > start and not lines[end - 1].strip():
+        end -= 1
+    lines = lines[start:end]
+    if lines:
+        lines[-1] = lines[-1].rstrip("\r\n")
+    return lines
+
+
+def intern_lines(a, b):
+    """Map every distinct line to a small integer; returns the two int lists."""
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    return a_ids, b_ids
+
+
+def longest_increasing(pairs):
+    """
+    Patience sorting: the longest run of (i, j) pairs, already ordered by j,
+    whose i values also increase.
+    """
+    tails, tail_index, previous = [], [], [None] * len(pairs)
+    for k, (i, _) in enumerate(pairs):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < i:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo:
+            previous[k] = tail_index[lo - 1]
+        if lo == len(tails):
+            tails.append(i)
+            tail_index.append(k)
+        else:
+            tails[lo] = i
+            tail_index[lo] = k
+
+    run, k = [], tail_index[-1] if tail_index else None
+    while k is not None:
+        run.append(pairs[k])
+        k = previous[k]
+    return run[::-1]
+
+
+def unique_anchors(a, b, a_lo, a_hi, b_lo, b_hi):
+    """Lines occurring exactly once in both ranges, as (i, j) in b order."""
+    seen_a = {}
+    for i in range(a_lo, a_hi):
+        seen_a[a[i]] = i if a[i] not in seen_a else -1
+    seen_b = {}
+    for j in range(b_lo, b_hi):
+        if seen_a.get(b[j], -1) >= 0:
+            seen_b[b[j]] = j if b[j] not in seen_b else -1
+    return [(seen_a[line], j) for line, j in sorted(seen_b.items(), key=lambda item: item[1]) if j >= 0]
+
+
+def rarest_anchor(a, b, a_lo, a_hi, b_lo, b_hi):
+    """First occurrence on both sides of the least repeated shared line, or None."""
+    counts, first_a = {}, {}
+    for i in range(a_lo, a_hi):
+        counts[a[i]] = counts.get(a[i], 0) + 1
+        first_a.setdefault(a[i], i)
+    best = None
+    for j in range(b_lo, b_hi):
+        count = counts.get(b[j])
+        if count and count <= MAX_ANCHOR_OCCURRENCES and (best is None or count < best[0]):
+            best = (count, first_a[b[j]], j)
+    return best[1:] if best else None
+
+
+def matching_pairs(a, b):
+    """All (i, j) with a[i] == b[j] that the diff keeps, in order."""
+    pairs = []
+    ranges = [(0, len(a), 0, len(b))]
+    while ranges:
+        a_lo, a_hi, b_lo, b_hi = ranges.pop()
+        # common prefix and suffix are matched without any searching
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            pairs.append((a_lo, b_lo))
+            a_lo, b_lo = a_lo + 1, b_lo + 1
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi, b_hi = a_hi - 1, b_hi - 1
+            pairs.append((a_hi, b_hi))
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+
+        anchors = longest_increasing(unique_anchors(a, b, a_lo, a_hi, b_lo, b_hi))
+        if not anchors:
+            anchor = rarest_anchor(a, b, a_lo, a_hi, b_lo, b_hi)
+            anchors = [anchor] if anchor else []
+        for i, j in anchors:
+            pairs.append((i, j))
+            ranges.append((a_lo, i, b_lo, j))
+            a_lo, b_lo = i + 1, j + 1
+        if anchors:
+            ranges.append((a_lo, a_hi, b_lo, b_hi))
+    pairs.sort()
+    return pairs
+
+
+def opcodes(a, b):
+    """difflib-style (tag, i1, i2, j1, j2) opcodes for two int sequences."""
+    codes = []
+    i = j = 0
+    for match_i, match_j in matching_pairs(a, b) + [(len(a), len(b))]:
+        if i < match_i and j < match_j:
+            codes.append(('replace', i, match_i, j, match_j))
+        elif i < match_i:
+            codes.append(('delete', i, match_i, j, j))
+        elif j < match_j:
+            codes.append(('insert', i, i, j, match_j))
+        if match_i < len(a):
+            if codes and codes[-1][0] == 'equal':
+                codes[-1] = ('equal', codes[-1][1], match_i + 1, codes[-1][3], match_j + 1)
+            else:
+                codes.append(('equal', match_i, match_i + 1, match_j, match_j + 1))
+        i, j = match_i + 1, match_j + 1
+    return codes
+
+
+def grouped(codes, n=3):
+    """Split opcodes into hunks with `n` lines of context, as difflib does."""
+    if not codes:
+        codes = [('equal', 0, 1, 0, 1)]
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def hunk_range(start, stop):
+    length = stop - start
+    beginning = start + 1
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def unified_diff(a, b, fromfile='', tofile='', n=3):
+    """Unified diff of two line lists, same output as difflib.unified_diff(lineterm='')."""
+    a_ids, b_ids = intern_lines(a, b)
+    started = False
+    for group in grouped(opcodes(a_ids, b_ids), n):
+        if not started:
+            started = True
+            yield f"--- {fromfile}"
+            yield f"+++ {tofile}"
+        first, last = group[0], group[-1]
+        yield f"@@ -{hunk_range(first[1], last[2])} +{hunk_range(first[3], last[4])} @@"
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            for line in a[i1:i2]:
+                yield '-' + line
+            for line in b[j1:j2]:
+                yield '+' + line
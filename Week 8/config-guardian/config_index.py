@@ -0,0 +1,311 @@
+# Inverted index over the backed-up configs.
+#
+# config_index.sqlite
+#   devices(id, hostname, size, mtime_ns)   stat of configs/<hostname>.cfg when indexed
+#   lines(id, text)                         every distinct normalized line, fleet-wide
+#   postings(line_id, device_id)            which devices carry which line
+#   tokens(token, line_id)                  lower-cased words of each distinct line
+#
+# Lines are normalized by stripping and collapsing whitespace, so an exact
+# query is one lookup. Substring and regex queries first intersect the token
+# postings of the words they must contain and only test the candidate lines;
+# a query without a usable word falls back to scanning the distinct lines.
+# update() only reindexes configs whose size or mtime changed.
+
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+INDEX_FILE = "config_index.sqlite"
+CONFIG_DIR = "configs"
+QUERY_MODES = ("exact", "substring", "regex")
+
+TOKEN = re.compile(r"[\w.:/-]+")
+WHITESPACE = re.compile(r"\s+")
+SQL_BATCH = 500   # host parameters per IN (...) query
+
+logger = logging.getLogger("config_guardian")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY, hostname TEXT UNIQUE NOT NULL, size INTEGER, mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, text TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS postings (
+    line_id INTEGER NOT NULL, device_id INTEGER NOT NULL, PRIMARY KEY (line_id, device_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_by_device ON postings (device_id, line_id);
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT NOT NULL, line_id INTEGER NOT NULL, PRIMARY KEY (token, line_id)
+) WITHOUT ROWID;
+"""
+
+
+def normalize_line(line):
+    return WHITESPACE.sub(" ", line.strip())
+
+
+def open_index(path=INDEX_FILE):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def chunks(items, size=SQL_BATCH):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def line_ids(db, texts):
+    """Ids of the given distinct lines, adding (and tokenizing) the new ones."""
+    ids = {}
+    for batch in chunks(texts):
+        marks = ",".join("?" * len(batch))
+        ids.update((text, line_id) for line_id, text in db.execute(
+            f"SELECT id, text FROM lines WHERE text IN ({marks})", batch))
+    for text in texts:
+        if text in ids:
+            continue
+        line_id = db.execute("INSERT INTO lines (text) VALUES (?)", (text,)).lastrowid
+        ids[text] = line_id
+        db.executemany(
+            "INSERT OR IGNORE INTO tokens (token, line_id) VALUES (?, ?)",
+            ((token, line_id) for token in set(TOKEN.findall(text.lower())))
+        )
+    return ids
+
+
+def index_device(db, hostname, config_file):
+    stat = os.stat(config_file)
+    with open(config_file, 'r', errors='replace') as f:
+        texts = {normalize_line(line) for line in f}
+    texts.discard("")
+
+    row = db.execute("SELECT id FROM devices WHERE hostname = ?", (hostname,)).fetchone()
+    if row:
+        device_id = row[0]
+        db.execute("DELETE FROM postings WHERE device_id = ?", (device_id,))
+        db.execute("UPDATE devices SET size = ?, mtime_ns = ? WHERE id = ?",
+                   (stat.st_size, stat.st_mtime_ns, device_id))
+    else:
+        device_id = db.execute(
+            "INSERT INTO devices (hostname, size, mtime_ns) VALUES (?, ?, ?)",
+            (hostname, stat.st_size, stat.st_mtime_ns)
+        ).lastrowid
+    db.executemany(
+        "INSERT INTO postings (line_id, device_id) VALUES (?, ?)",
+        ((line_id, device_id) for line_id in line_ids(db, texts).values())
+    )
+
+
+def drop_device(db, hostname):
+    row = db.execute("SELECT id FROM devices WHERE hostname = ?", (hostname,)).fetchone()
+    if row:
+        db.execute("DELETE FROM postings WHERE device_id = ?", (row[0],))
+        db.execute("DELETE FROM devices WHERE id = ?", (row[0],))
+
+
+def update(config_dir=CONFIG_DIR, path=INDEX_FILE):
+    """
+    Bring the index in line with config_dir: configs whose size or mtime
+    changed are reindexed, deleted ones dropped. Returns (reindexed, dropped).
+    """
+    on_disk = {}
+    for filename in os.listdir(config_dir) if os.path.isdir(config_dir) else []:
+        if filename.endswith(".cfg"):
+            stat = os.stat(os.path.join(config_dir, filename))
+            on_disk[filename[:-4]] = (stat.st_size, stat.st_mtime_ns)
+
+    db = open_index(path)
+    try:
+        indexed = {hostname: (size, mtime_ns) for hostname, size, mtime_ns
+                   in db.execute("SELECT hostname, size, mtime_ns FROM devices")}
+        changed = [hostname for hostname, signature in on_disk.items() if indexed.get(hostname) != signature]
+        removed = [hostname for hostname in indexed if hostname not in on_disk]
+        with db:
+            for hostname in changed:
+                index_device(db, hostname, os.path.join(config_dir, f"{hostname}.cfg"))
+            for hostname in removed:
+                drop_device(db, hostname)
+    finally:
+        db.close()
+    return len(changed), len(removed)
+
+
+def prune(path=INDEX_FILE):
+    """Drop lines no device carries any more; returns how many were removed."""
+    db = open_index(path)
+    try:
+        with db:
+            orphans = [line_id for line_id, in db.execute(
+                "SELECT id FROM lines WHERE id NOT IN (SELECT line_id FROM postings)")]
+            for batch in chunks(orphans):
+                marks = ",".join("?" * len(batch))
+                db.execute(f"DELETE FROM tokens WHERE line_id IN ({marks})", batch)
+                db.execute(f"DELETE FROM lines WHERE id IN ({marks})", batch)
+        db.execute("VACUUM")
+    finally:
+        db.close()
+    return len(orphans)
+
+
+def required_tokens(fragment):
+    """
+    Token lookups every line containing `fragment` must satisfy, as
+    (token, is_prefix). Words cut by either end of the fragment may be parts
+    of longer tokens: a word open only at its end becomes a prefix lookup,
+    a word open at its start can't be looked up and is left out.
+    """
+    lookups = []
+    fragment = fragment.lower()
+    for match in TOKEN.finditer(fragment):
+        if match.start() == 0:
+            continue
+        lookups.append((match.group(), match.end() == len(fragment)))
+    return lookups
+
+
+def regex_literals(pattern):
+    """Literal runs every match of `pattern` must contain (empty when unsure)."""
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return []
+    runs, run = [], []
+    for op, value in parsed:
+        if op is sre_parse.LITERAL:
+            run.append(chr(value))
+            continue
+        if op is sre_parse.BRANCH:
+            return []   # alternatives at the top level: no literal is required
+        if run:
+            runs.append("".join(run))
+        run = []
+    if run:
+        runs.append("".join(run))
+    return runs
+
+
+def candidate_lines(db, lookups):
+    """Ids of the lines having every token lookup, or None when there are no lookups."""
+    candidates = None
+    # most selective lookups first, so the intersection shrinks fast
+    for token, is_prefix in sorted(set(lookups), key=lambda lookup: (lookup[1], -len(lookup[0]))):
+        if is_prefix:
+            rows = db.execute(
+                "SELECT line_id FROM tokens WHERE token >= ? AND token < ?", (token, token + "\U0010ffff"))
+        else:
+            rows = db.execute("SELECT line_id FROM tokens WHERE token = ?", (token,))
+        found = {line_id for line_id, in rows}
+        candidates = found if candidates is None else candidates & found
+        if not candidates:
+            break
+    return candidates
+
+
+def matching_lines(db, mode, text, ignore_case=False):
+    """{line_id: line} of the distinct lines matching the query."""
+    if mode == "exact":
+        if ignore_case:
+            rows = db.execute("SELECT id, text FROM lines WHERE text = ? COLLATE NOCASE", (normalize_line(text),))
+        else:
+            rows = db.execute("SELECT id, text FROM lines WHERE text = ?", (normalize_line(text),))
+        return dict(rows)
+
+    if mode == "substring":
+        needle = normalize_line(text)
+        lookups = required_tokens(needle)
+        if ignore_case:
+            needle = needle.lower()
+            test = lambda line: needle in line.lower()
+        else:
+            test = lambda line: needle in line
+    else:
+        regex = re.compile(text, re.IGNORECASE if ignore_case else 0)
+        lookups = [lookup for literal in regex_literals(text) for lookup in required_tokens(literal)]
+        test = lambda line: regex.search(line) is not None
+
+    candidates = candidate_lines(db, lookups)
+    if candidates is None:
+        rows = db.execute("SELECT id, text FROM lines")
+    else:
+        rows = (row for batch in chunks(candidates) for row in db.execute(
+            f"SELECT id, text FROM lines WHERE id IN ({','.join('?' * len(batch))})", batch))
+    return {line_id: line for line_id, line in rows if test(line)}
+
+
+def query(text, mode="substring", ignore_case=False, path=INDEX_FILE):
+    """{hostname: [matching lines]} for an exact-line, substring or regex query."""
+    db = open_index(path)
+    try:
+        lines = matching_lines(db, mode, text, ignore_case)
+        results = {}
+        for batch in chunks(lines):
+            marks = ",".join("?" * len(batch))
+            for hostname, line_id in db.execute(
+                    f"SELECT d.hostname, p.line_id FROM postings p JOIN devices d ON d.id = p.device_id "
+                    f"WHERE p.line_id IN ({marks})", batch):
+                results.setdefault(hostname, []).append(lines[line_id])
+    finally:
+        db.close()
+    return {hostname: sorted(found) for hostname, found in sorted(results.items())}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Search the backed-up configs.")
+    parser.add_argument("--index", default=INDEX_FILE, help=f"Index file (default: {INDEX_FILE})")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    search = sub.add_parser("query", help="Find the devices carrying a config line.")
+    search.add_argument("text", help="Line, substring or regex to look for")
+    modes = search.add_mutually_exclusive_group()
+    modes.add_argument("--exact", dest="mode", action="store_const", const="exact",
+                       help="Match whole (whitespace-normalized) lines")
+    modes.add_argument("--regex", dest="mode", action="store_const", const="regex",
+                       help="Treat text as a Python regular expression")
+    search.add_argument("-c", "--count", action="store_true", help="Only print the matching hostnames")
+    search.add_argument("-I", "--ignore-case", action="store_true", help="Case-insensitive match")
+    search.set_defaults(mode="substring")
+
+    refresh = sub.add_parser("update", help="Reindex configs that changed since the last update.")
+    refresh.add_argument("config_dir", nargs="?", default=CONFIG_DIR)
+
+    sub.add_parser("prune", help="Drop lines no device has any more and compact the index.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parse_args()
+
+    if args.command == "query":
+        start = time.perf_counter()
+        try:
+            results = query(args.text, args.mode, args.ignore_case, path=args.index)
+        except re.error as e:
+            raise SystemExit(f"Invalid regex: {e}")
+        elapsed = (time.perf_counter() - start) * 1000
+        for hostname, lines in results.items():
+            if args.count:
+                print(hostname)
+                continue
+            for line in lines:
+                print(f"{hostname}: {line}")
+        logger.info("%d devices matched in %.1f ms", len(results), elapsed)
+    elif args.command == "update":
+        start = time.perf_counter()
+        reindexed, dropped = update(args.config_dir, path=args.index)
+        logger.info("Reindexed %d configs, dropped %d in %.1fs", reindexed, dropped, time.perf_counter() - start)
+    elif args.command == "prune":
+        print(f"Removed {prune(path=args.index)} unused lines")
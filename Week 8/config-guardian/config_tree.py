@@ -0,0 +1,140 @@
+# Section trees (Merkle trees) of device configs.
+#
+# A config is parsed into its blocks by indentation: "interface Gi0/1",
+# "router bgp 65000" > "address-family ipv4", Junos "interfaces" >
+# "ge-0/0/0" > "unit 0", RouterOS "/ip address". Every section is hashed
+# over its own lines and its children's hashes, so two trees are compared
+# by walking only the sections whose hashes differ.
+#
+# Trees are cached in config_trees/<hostname>.json together with the
+# normalized-config hash they were built from.
+
+import hashlib
+import json
+import os
+
+import atomic_file
+
+TREES_DIR = "config_trees"
+
+# Lines that only close or separate blocks
+DELIMITERS = {"!", "#", "}", "exit", "quit", "end", "return"}
+
+
+def parse_sections(lines, device_type=None):
+    """
+    Nest config lines by indentation; returns [(text, children), ...].
+    RouterOS /export is flat, so there every "/path" line opens a section.
+    """
+    root = []
+    stack = [(-1, root)]
+    in_path = False
+    for line in lines:
+        text = line.rstrip()
+        stripped = text.strip()
+        if not stripped or stripped in DELIMITERS:
+            continue
+        indent = len(text) - len(text.lstrip())
+        if device_type == 'mikrotik_routeros':
+            if indent == 0 and stripped.startswith("/"):
+                in_path = True
+            elif in_path:
+                indent += 1
+        while stack[-1][0] >= indent:
+            stack.pop()
+        children = []
+        stack[-1][1].append((stripped.rstrip("{").rstrip(), children))
+        stack.append((indent, children))
+    return root
+
+
+def unique_name(sections, name):
+    if name not in sections:
+        return name
+    n = 2
+    while f"{name} ({n})" in sections:
+        n += 1
+    return f"{name} ({n})"
+
+
+def hash_node(own_lines, sections):
+    own = hashlib.sha256("\n".join(own_lines).encode()).hexdigest()
+    digest = hashlib.sha256(own.encode())
+    for name, child in sections.items():
+        digest.update(f"\n{name}\0{child['hash']}".encode())
+    node = {'hash': digest.hexdigest(), 'own': own}
+    if sections:
+        node['sections'] = sections
+    return node
+
+
+def build_node(parsed):
+    own_lines, sections = [], {}
+    for text, children in parsed:
+        if children:
+            sections[unique_name(sections, text)] = build_node(children)
+        else:
+            own_lines.append(text)
+    return hash_node(own_lines, sections)
+
+
+def build_tree(lines, device_type=None):
+    """
+    Merkle tree of a (normalized) config. Top-level lines without a block,
+    like "hostname R1" or "snmp-server ...", are grouped into one section
+    per keyword so they are reported by name as well.
+    """
+    sections, grouped = {}, {}
+    for text, children in parse_sections(lines, device_type):
+        if children:
+            sections[unique_name(sections, text)] = build_node(children)
+        else:
+            grouped.setdefault(text.split()[0], []).append(text)
+    for keyword, own_lines in grouped.items():
+        sections[unique_name(sections, keyword)] = hash_node(own_lines, {})
+    return hash_node([], sections)
+
+
+def changed_sections(old, new, path=()):
+    """
+    Sections that differ between two trees, as " > "-joined paths with
+    "(added)" / "(removed)" where a whole section came or went. Only
+    subtrees whose hashes differ are visited.
+    """
+    if old['hash'] == new['hash']:
+        return []
+    old_sections, new_sections = old.get('sections', {}), new.get('sections', {})
+    # the change is inside the children only: name them rather than this block
+    if path and (old['own'] != new['own'] or not old_sections or not new_sections):
+        return [" > ".join(path)]
+
+    changes = []
+    for name, node in new_sections.items():
+        if name not in old_sections:
+            changes.append(" > ".join(path + (name,)) + " (added)")
+        else:
+            changes += changed_sections(old_sections[name], node, path + (name,))
+    for name in old_sections:
+        if name not in new_sections:
+            changes.append(" > ".join(path + (name,)) + " (removed)")
+    # same children, only in a different order
+    return changes or [" > ".join(path) or "(order)"]
+
+
+def tree_path(hostname, root=TREES_DIR):
+    return os.path.join(root, f"{hostname}.json")
+
+
+def load_tree(hostname, digest, root=TREES_DIR):
+    """Cached tree for `hostname` if it was built from the config hashing to `digest`."""
+    path = tree_path(hostname, root)
+    if not digest or not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        cached = json.load(f)
+    return cached['tree'] if cached.get('sha256') == digest else None
+
+
+def save_tree(hostname, digest, tree, root=TREES_DIR):
+    with atomic_file.atomic_open(tree_path(hostname, root)) as f:
+        json.dump({'sha256': digest, 'tree': tree}, f)
@@ -0,0 +1,518 @@
+# Local farm of fake SSH devices for load-testing guardian and friends.
+#
+# Every virtual device listens on its own loopback address (127.1.x.y,
+# all on the same port) so tools that key devices by host keep them
+# apart. Each one runs a small CLI on top of paramiko's server mode:
+# Cisco / VRP / Junos / RouterOS prompts, the guardian.py COMMANDS and
+# the MAC finder / command dispatcher show commands, with `| include`
+# and `| match` filters. Running configs are the files in configs/, each
+# given a unique hostname. The files guardian's --file-transfer pulls are
+# served too: `scp -f` for Cisco flash, SFTP for juniper.conf.gz and
+# RouterOS exports.
+#
+#   python device_farm.py --devices 1000 --latency 0.05 --inventory farm_hosts.yaml
+#
+# then point guardian (or anything netmiko-based) at farm_hosts.yaml.
+# Loopback addresses beyond 127.0.0.1 need Linux; they work out of the box there.
+
+import argparse
+import glob
+import gzip
+import io
+import logging
+import os
+import random
+import re
+import selectors
+import socket
+import threading
+import time
+
+import paramiko
+import yaml
+
+import guardian
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FARM_PORT = 10022
+USERNAME = "farm"
+PASSWORD = "farm"
+
+# How each vendor's CLI looks and complains
+PROMPTS = {
+    'cisco_ios': "{hostname}#",
+    'huawei_vrp': "<{hostname}>",
+    'juniper_junos': "{username}@{hostname}> ",
+    'mikrotik_routeros': "[{username}@{hostname}] > ",
+}
+ERRORS = {
+    'cisco_ios': "% Invalid input detected at '^' marker.",
+    'huawei_vrp': "Error: Unrecognized command found at '^' position.",
+    'juniper_junos': "syntax error.",
+    'mikrotik_routeros': "bad command name",
+}
+# Commands that only set up the terminal: command prefix -> reply
+SESSION_COMMANDS = {
+    'terminal ': "",
+    'screen-length ': "",
+    'screen-width ': "",
+    'set cli screen-length': "Screen length set to 0",
+    'set cli screen-width': "Screen width set to 511",
+    'set cli complete-on-space': "Disabling complete-on-space",
+    'enable': "",
+}
+# Failure injection: mode -> what the device does
+FAILURE_MODES = ("down", "hang", "auth", "drop")
+
+logger = logging.getLogger("device_farm")
+
+
+def detect_vendor(config):
+    for device_type in PROMPTS:
+        if guardian.parse_hostname(device_type, config):
+            return device_type
+    return 'cisco_ios'
+
+
+def rename(device_type, config, hostname):
+    """Give the config a new hostname (only on the hostname line itself)."""
+    pattern = guardian.COMMANDS[device_type]['hostname_pattern']
+    match = re.search(pattern, config, re.MULTILINE)
+    if not match:
+        return config
+    old = match.group(1)
+    new = hostname + (";" if old.endswith(";") else "")
+    return config[:match.start(1)] + new + config[match.end(1):]
+
+
+def ios_file(config):
+    """
+    The config as `copy running-config flash:` writes it: without the
+    "Building configuration" / "Current configuration" header `show run`
+    prints, and with a blank line before and after it.
+    """
+    body = re.sub(r"\A(?:Building configuration.*\n|[ \t]*\n|Current configuration.*\n)*", "", config)
+    return "\n" + body.rstrip("\n") + "\n\n"
+
+
+class FakeDevice:
+    """One virtual device: its config, CLI behaviour and injected faults."""
+
+    def __init__(self, address, device_type, config, hostname, latency=0.0, mode="ok"):
+        self.address = address
+        self.device_type = device_type
+        self.hostname = hostname
+        self.config = rename(device_type, config, hostname)
+        self.latency = latency
+        self.mode = mode
+        self.interfaces = re.findall(r"^(?:interface\s+)(\S+)", self.config, re.MULTILINE)
+        # files on flash / disk, by path
+        self.files = {}
+        if device_type == 'juniper_junos':
+            self.files['/config/juniper.conf.gz'] = gzip.compress(self.config.encode())
+
+    def prompt(self):
+        return PROMPTS[self.device_type].format(hostname=self.hostname, username=USERNAME)
+
+    def inventory_entry(self, port):
+        return {
+            'device_type': self.device_type,
+            'host': self.address,
+            'port': port,
+            'username': USERNAME,
+            'password': PASSWORD,
+            'secret': PASSWORD,
+        }
+
+    def ask(self, command):
+        """
+        (question, answer) for a command that asks before it acts, where
+        answer(reply) gives the output once the question is answered, or
+        the next (question, answer).
+        """
+        match = re.match(r"copy running-config (flash:(\S+))$", command.strip())
+        if not match or self.device_type != 'cisco_ios':
+            return None
+        path, name = match.groups()
+
+        def copy(path):
+            self.files[path] = ios_file(self.config).encode()
+            return f"{len(self.config)} bytes copied in 0.052 secs"
+
+        def answer(reply):
+            path = f"flash:{reply.strip() or name}"
+            if path not in self.files:
+                return copy(path)
+            # [confirm] takes Enter (or y) as yes, anything else as no
+            return ("%Warning:There is a file already existing with this name\n"
+                    "Do you want to over write? [confirm]",
+                    lambda reply: copy(path) if reply.strip() in ("", "y") else "%Error: copy aborted")
+        return f"Destination filename [{name}]? ", answer
+
+    def run(self, command):
+        """Output of one CLI line, without the prompt."""
+        command = command.strip()
+        if not command:
+            return ""
+        base, _, pipe = command.partition("|")
+        output = self.show(base.strip())
+        if output is None:
+            return ERRORS[self.device_type]
+        if pipe:
+            kind, _, pattern = pipe.strip().partition(" ")
+            if kind in ("include", "inc", "i", "match"):
+                output = self.filter(output, pattern.strip().strip('"'))
+        return output
+
+    @staticmethod
+    def filter(output, pattern):
+        try:
+            regex = re.compile(pattern)
+        except re.error:
+            regex = re.compile(re.escape(pattern))
+        return "\n".join(line for line in output.splitlines() if regex.search(line))
+
+    def show(self, command):
+        for prefix, reply in SESSION_COMMANDS.items():
+            if command.startswith(prefix):
+                return reply
+        running = guardian.COMMANDS[self.device_type]['running_config']
+        if command in (running, "show run", "show running-config"):
+            return self.config.rstrip("\n")
+        if command in ("show mac address-table", "display mac-address"):
+            return self.mac_table()
+        if command in ("show ip int b", "show ip interface brief"):
+            return self.ip_interfaces()
+        if command == "show ip route":
+            return self.routes()
+        if command == "/system identity print":
+            return f"  name: {self.hostname}"
+        if self.device_type == 'mikrotik_routeros' and command.startswith("/export file="):
+            self.files[command.partition("=")[2] + ".rsc"] = self.config.encode()
+            return ""
+        for remove in ("delete /force ", "/file remove "):
+            if command.startswith(remove):
+                self.files.pop(command[len(remove):].strip(), None)
+                return ""
+        return None
+
+    def addresses(self):
+        """(interface, ip, mask) for every interface with an IPv4 address."""
+        found = []
+        for block in re.split(r"^(?=interface\s)", self.config, flags=re.MULTILINE):
+            name = re.match(r"interface\s+(\S+)", block)
+            address = re.search(r"^\s+ip address\s+(\d+\.\d+\.\d+\.\d+)\s+(\d+\.\d+\.\d+\.\d+)", block, re.MULTILINE)
+            if name and address:
+                found.append((name.group(1), address.group(1), address.group(2)))
+        return found
+
+    def ip_interfaces(self):
+        lines = ["Interface              IP-Address      OK? Method Status                Protocol"]
+        with_ip = {name: ip for name, ip, _ in self.addresses()}
+        for name in self.interfaces:
+            ip = with_ip.get(name, "unassigned")
+            lines.append(f"{name:<22} {ip:<15} YES manual up                    up")
+        return "\n".join(lines)
+
+    def routes(self):
+        lines = ["Codes: C - connected, S - static, L - local", "", "Gateway of last resort is not set", ""]
+        for name, ip, mask in self.addresses():
+            prefix = sum(bin(int(octet)).count("1") for octet in mask.split("."))
+            lines.append(f"C        {ip}/{prefix} is directly connected, {name}")
+        return "\n".join(lines)
+
+    def mac_table(self):
+        rng = random.Random(self.address)
+        ports = self.interfaces or ["Ethernet0/0"]
+        entries = [
+            (rng.randrange(1, 100), [rng.randrange(256) for _ in range(6)], rng.choice(ports))
+            for _ in range(20)
+        ]
+        if self.device_type == 'huawei_vrp':
+            lines = ["MAC address table of slot 0:", "-" * 60,
+                     "MAC Address    VLAN/VSI/BD   Learned-From   Type", "-" * 60]
+            for vlan, mac, port in entries:
+                octets = "".join(f"{b:02x}" for b in mac)
+                lines.append(f"{octets[0:4]}-{octets[4:8]}-{octets[8:12]} {vlan}/-/-  {port}  dynamic")
+        else:
+            lines = ["          Mac Address Table", "-" * 43, "",
+                     "Vlan    Mac Address       Type        Ports", "----    -----------       --------    -----"]
+            for vlan, mac, port in entries:
+                octets = "".join(f"{b:02x}" for b in mac)
+                lines.append(f"{vlan:>4}    {octets[0:4]}.{octets[4:8]}.{octets[8:12]}    DYNAMIC     {port}")
+        return "\n".join(lines)
+
+
+class DeviceServer(paramiko.ServerInterface):
+    def __init__(self, device):
+        self.device = device
+        self.shell_ready = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        # netmiko appends terminal options to RouterOS logins ("farm+ct511w4098h")
+        if self.device.mode != "auth" and username.split("+")[0] == USERNAME and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.shell_ready.set()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode(errors="replace")
+        if not command.startswith("scp -f "):
+            return False
+        threading.Thread(target=serve_scp, args=(channel, self.device, command[7:].strip()),
+                         daemon=True).start()
+        return True
+
+
+class FarmSFTP(paramiko.SFTPServerInterface):
+    """Read-only SFTP view of a device's files."""
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.device = server.device
+
+    def attributes(self, path):
+        data = self.device.files.get(path.lstrip("/")) or self.device.files.get(path)
+        if data is None:
+            return None, paramiko.SFTP_NO_SUCH_FILE
+        attrs = paramiko.SFTPAttributes()
+        attrs.st_size, attrs.st_mode = len(data), 0o100644
+        return data, attrs
+
+    def stat(self, path):
+        data, attrs = self.attributes(path)
+        return attrs
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        data, attrs = self.attributes(path)
+        if data is None:
+            return attrs
+        handle = paramiko.SFTPHandle(flags)
+        handle.readfile = io.BytesIO(data)
+        handle.stat = lambda: attrs
+        return handle
+
+
+def serve_scp(channel, device, path):
+    """Source side of `scp -f`: send one file and wait for the acknowledgements."""
+    try:
+        data = device.files.get(path)
+        if channel.recv(1) != b"\0":
+            return
+        if data is None:
+            channel.sendall(f"\x01scp: {path}: No such file or directory\n".encode())
+            return
+        channel.sendall(f"C0644 {len(data)} {path.rpartition(':')[2]}\n".encode())
+        if channel.recv(1) != b"\0":
+            return
+        channel.sendall(data + b"\0")
+        channel.recv(1)
+    except (EOFError, OSError, paramiko.SSHException):
+        pass
+    finally:
+        channel.send_exit_status(0)
+        channel.close()
+
+
+def serve_shell(channel, device):
+    """Line-based CLI: echo input, answer each line, print the prompt again."""
+    newline = "\r\n"
+    channel.sendall(f"{newline}{device.prompt()}".encode())
+    pending, last = "", ""
+    answer = None  # set while a command waits for the reply to its question
+    while True:
+        data = channel.recv(4096)
+        if not data:
+            return
+        text = data.decode(errors="replace")
+        # terminal echo (netmiko looks for its command in it), Enter as CRLF;
+        # echoed line by line, as each line is answered, like a real CLI
+        echo = ""
+        for char in text:
+            if char in "\r\n":
+                if char == "\n" and last == "\r":
+                    last = char
+                    continue
+                last = char
+                channel.sendall(f"{echo}{newline}".encode())
+                echo = ""
+                line, pending = pending, ""
+                if line.strip() in ("exit", "quit", "logout"):
+                    return
+                # the output of the line, or a (question, answer) to ask first
+                result = answer(line) if answer else device.ask(line)
+                answer = None
+                if isinstance(result, tuple):
+                    channel.sendall(result[0].replace("\n", newline).encode())
+                    answer = result[1]
+                    continue
+                output = device.run(line) if result is None else result
+                if device.latency:
+                    time.sleep(device.latency)
+                if device.mode == "drop" and len(output) > 1000:
+                    # connection dies halfway through a long output
+                    channel.sendall(output[:len(output) // 2].replace("\n", newline).encode())
+                    return
+                reply = output.replace("\n", newline) + newline if output else ""
+                channel.sendall(f"{reply}{device.prompt()}".encode())
+            elif char == "\x03":
+                # Ctrl+C drops the line being typed and any open question
+                last, pending, echo, answer = char, "", "", None
+                channel.sendall(f"^C{newline}{device.prompt()}".encode())
+            else:
+                last = char
+                pending += char
+                echo += char
+        if echo:
+            channel.sendall(echo.encode())
+
+
+class DeviceFarm:
+    """
+    A set of FakeDevices served from one process.
+    :param devices: number of virtual devices
+    :param latency: seconds added to the SSH handshake and every command
+    :param failures: {mode: fraction of devices} for the FAILURE_MODES
+    """
+
+    def __init__(self, devices, port=FARM_PORT, latency=0.0, failures=None, seed=0, configs=None):
+        self.port = port
+        self.selector = selectors.DefaultSelector()
+        self.stopping = threading.Event()
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+        rng = random.Random(seed)
+        configs = configs or sorted(glob.glob(os.path.join(HERE, guardian.CONFIG_DIR, "*.cfg")))
+        texts = []
+        for path in configs:
+            with open(path) as f:
+                text = f.read()
+            texts.append((detect_vendor(text), text))
+
+        self.devices = []
+        for i in range(devices):
+            address = f"127.1.{i // 250}.{i % 250 + 1}"
+            device_type, text = texts[i % len(texts)]
+            mode = "ok"
+            roll = rng.random()
+            for name in FAILURE_MODES:
+                share = (failures or {}).get(name, 0.0)
+                if roll < share:
+                    mode = name
+                    break
+                roll -= share
+            self.devices.append(FakeDevice(
+                address, device_type, text, f"farm-{address.replace('.', '-')}", latency, mode
+            ))
+
+    def start(self):
+        for device in self.devices:
+            if device.mode == "down":
+                continue  # nothing listens: connection refused
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((device.address, self.port))
+            listener.listen(16)
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ, device)
+        threading.Thread(target=self.accept_loop, name="farm-accept", daemon=True).start()
+        logger.info("Farm up: %d devices on port %d", len(self.devices), self.port)
+        return self
+
+    def accept_loop(self):
+        while not self.stopping.is_set():
+            for key, _ in self.selector.select(timeout=0.5):
+                try:
+                    conn, _ = key.fileobj.accept()
+                except OSError:
+                    continue
+                conn.setblocking(True)
+                threading.Thread(target=self.handle, args=(conn, key.data), daemon=True).start()
+
+    def handle(self, conn, device):
+        if device.mode == "hang":
+            # TCP is up but SSH never starts: the client waits for its timeout
+            self.stopping.wait()
+            conn.close()
+            return
+        if device.latency:
+            time.sleep(device.latency)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, FarmSFTP)
+        server = DeviceServer(device)
+        try:
+            transport.start_server(server=server)
+            channel = transport.accept(timeout=30)
+            if channel is None or not server.shell_ready.wait(10):
+                return
+            serve_shell(channel, device)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            transport.close()
+
+    def inventory(self):
+        return {'devices': [device.inventory_entry(self.port) for device in self.devices]}
+
+    def write_inventory(self, path):
+        with open(path, 'w') as f:
+            yaml.safe_dump(self.inventory(), f, sort_keys=False)
+
+    def stop(self):
+        self.stopping.set()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fake multi-vendor SSH device farm.")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--port", type=int, default=FARM_PORT, help=f"SSH port on every device (default: {FARM_PORT})")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds added to the handshake and to every command (default: 0)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--inventory", default="farm_hosts.yaml",
+                        help="Inventory file to write for guardian (default: farm_hosts.yaml)")
+    for mode in FAILURE_MODES:
+        parser.add_argument(f"--{mode}-rate", type=float, default=0.0,
+                            help=f"Fraction of devices that are '{mode}'")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parse_args()
+    failures = {mode: getattr(args, f"{mode}_rate") for mode in FAILURE_MODES}
+    farm = DeviceFarm(args.devices, args.port, args.latency, failures, args.seed)
+    with farm:
+        farm.write_inventory(args.inventory)
+        # the benchmark harness waits for this line
+        print(f"ready {args.inventory}", flush=True)
+        try:
+            farm.stopping.wait()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,180 @@
+# Copying configs off devices as files instead of screen-scraping them.
+#
+# Both protocols run on a new channel of the SSH transport the CLI session
+# already has open, so no second login is paid:
+#   scp    the source side of the rcp protocol (`scp -f PATH`), which is
+#          what IOS's SCP server speaks
+#   sftp   paramiko's SFTP client (Junos, RouterOS)
+#
+# The file is written to disk chunk by chunk as it arrives (gunzipped on
+# the way for Junos' juniper.conf.gz) and hashed on the way with the same
+# normalized SHA-256 guardian keeps in config_hashes.json, so an unchanged
+# config is recognised without ever loading it into memory. The file and
+# the CLI output of the same config differ in their header (dropped as
+# noise) and in the blank lines and line break around it, which the hash
+# leaves out the way config_diff.clean_lines does; switching a device
+# between the two does not show up as a change.
+
+import codecs
+import hashlib
+import zlib
+
+import paramiko
+
+import atomic_file
+
+PROTOCOLS = ("scp", "sftp")
+CHUNK_SIZE = 32768
+
+
+class TransferError(Exception):
+    pass
+
+
+def chomp(text):
+    """`text` without one final line break."""
+    for ending in ("\r\n", "\n", "\r"):
+        if text.endswith(ending):
+            return text[:-len(ending)]
+    return text
+
+
+class ConfigHasher:
+    """
+    SHA-256 of a config fed in arbitrary byte chunks, leaving out the lines
+    `noise` matches. Gives the same digest as hashing the decoded text's
+    splitlines(keepends=True) after config_diff.clean_lines.
+    """
+
+    def __init__(self, noise=None):
+        self.sha = hashlib.sha256()
+        self.noise = noise
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.tail = ""
+        # the last non-blank line and the blank lines after it are only
+        # hashed once more config follows them
+        self.last = None
+        self.blanks = []
+
+    def feed(self, text, final=False):
+        lines = (self.tail + text).splitlines(keepends=True)
+        # the last line may continue in the next chunk (even after a lone \r)
+        self.tail = lines.pop() if lines and not final else ""
+        for line in lines:
+            if self.noise is not None and self.noise.match(line):
+                continue
+            if not line.strip():
+                if self.last is not None:
+                    self.blanks.append(line)
+                continue
+            if self.last is not None:
+                self.sha.update(self.last.encode())
+                self.sha.update("".join(self.blanks).encode())
+            self.last, self.blanks = line, []
+
+    def update(self, data):
+        self.feed(self.decoder.decode(data))
+
+    def hexdigest(self):
+        self.feed(self.decoder.decode(b"", final=True), final=True)
+        if self.last is not None:
+            self.sha.update(self.last.rstrip("\r\n").encode())
+            self.last = None
+        return self.sha.hexdigest()
+
+
+def read_line(channel):
+    line = b""
+    while not line.endswith(b"\n"):
+        byte = channel.recv(1)
+        if not byte:
+            raise TransferError("connection closed during the scp handshake")
+        line += byte
+    return line
+
+
+def scp_chunks(transport, path, timeout=None):
+    """Yield the contents of the remote file `path`, fetched with `scp -f`."""
+    channel = transport.open_session(timeout=timeout)
+    try:
+        channel.settimeout(timeout)
+        channel.exec_command(f"scp -f {path}")
+        channel.sendall(b"\0")
+        header = read_line(channel)
+        if header[:1] in (b"\x01", b"\x02"):
+            raise TransferError(header[1:].decode(errors="replace").strip())
+        if not header.startswith(b"C"):
+            raise TransferError(f"unexpected scp reply {header[:80]!r}")
+        size = int(header.split()[1])
+        channel.sendall(b"\0")
+
+        remaining = size
+        while remaining:
+            data = channel.recv(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise TransferError(f"connection closed after {size - remaining} of {size} bytes")
+            remaining -= len(data)
+            yield data
+        if channel.recv(1) != b"\0":
+            raise TransferError("no end-of-file acknowledgement from the scp server")
+        channel.sendall(b"\0")
+    finally:
+        channel.close()
+
+
+def sftp_chunks(transport, path, timeout=None):
+    """Yield the contents of the remote file `path` over SFTP."""
+    sftp = paramiko.SFTPClient.from_transport(transport)
+    try:
+        sftp.get_channel().settimeout(timeout)
+        with sftp.open(path, 'rb') as f:
+            # pipeline the reads instead of one round trip per chunk
+            f.prefetch()
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+    finally:
+        sftp.close()
+
+
+def gunzipped(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+    if not decompressor.eof:
+        raise TransferError("truncated gzip file")
+
+
+def fetch(transport, protocol, remote_path, local_path, gunzip=False, noise=None, timeout=None):
+    """
+    Copy `remote_path` to `local_path` as it streams in, hashing on the way.
+    Returns (normalized sha256, bytes written).
+    :param transport: paramiko transport of an open session
+    :param gunzip: the remote file is gzip-compressed; store it decompressed
+    :param noise: compiled noise regex of the vendor, for the hash
+    """
+    if protocol not in PROTOCOLS:
+        raise ValueError(f"Unknown transfer protocol {protocol!r}")
+    chunks = (scp_chunks if protocol == "scp" else sftp_chunks)(transport, remote_path, timeout)
+    if gunzip:
+        chunks = gunzipped(chunks)
+
+    hasher = ConfigHasher(noise)
+    size = 0
+    try:
+        with atomic_file.atomic_open(local_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                hasher.update(chunk)
+                size += len(chunk)
+    except BaseException:
+        chunks.close()
+        raise
+    return hasher.hexdigest(), size
@@ -1,53 +1,246 @@
 # import relevant modules
 import yaml
 from netmiko import ConnectHandler
+from netmiko.exceptions import ReadTimeout
+import paramiko
 import os
-import difflib
-import shutil
 from datetime import datetime
 import subprocess
 import re
 from functools import wraps
+from contextlib import contextmanager
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from threading import Lock
+from threading import Event, Lock, Thread, local
 import argparse
+import queue
+import hashlib
+import zlib
+import json
+import shutil
+import filecmp
+import atomic_file
+import snapshot_store
+import config_diff
+import config_index
+import compliance
+import config_tree
+import file_transfer
+import run_journal
+import reachability
+import sharding
+import syslog_listener
+import time
+import heapq
+import random
+import signal
+import socket
+import atexit
+import metrics
+from concurrency import SPAWN, ConcurrencyController, spawn_pool
+import asyncio
+try:
+    import asyncssh
+except ImportError:  # only --engine asyncio needs it
+    asyncssh = None
 
 # Create one global lock
 git_lock = Lock()
 
+# Sidecar index of normalized config hashes:
+# hostname -> {sha256, size, last_seen, host, device_type, probe}
+config_hashes = {}
+hostnames_by_host = {}
+hash_lock = Lock()
+
+# Run the cheap change probe before pulling the full config (--probe)
+probe_changes = False
+PROBE_UNCHANGED = "<probe: unchanged>"  # returned instead of the running config
+
+# Per-thread facts about the current SSH session (e.g. connect latency)
+session = local()
+
+# Per-device phase timings from the latest run, keyed by device address:
+# host -> {device_type, phases: {phase: seconds}, total, last_run}
+device_timings = {}
+timings_lock = Lock()
+
+# One record per device processed since the last report (see metrics.py):
+# host -> {host, hostname, device_type, site, outcome, phases, total}
+run_records = {}
+
+# Prometheus textfile to update after each run / daemon flush (--metrics-file)
+metrics_file = None
+# Device types of the config changes committed since the textfile was last
+# written; a change waiting in a batch only counts once commit_batch succeeds
+committed_changes = []
+
+# Compliance rule pack checked after each run / daemon flush (--compliance)
+compliance_rules = None
+
+# This node's name in a sharded run (--shard); its changes are left for --merge-shards
+shard_node = None
+
+# In a --processes worker: queue back to the parent, which journals the
+# devices and does every git step
+worker_events = None
+
+# Inventory keys guardian uses itself; never passed to netmiko
+GUARDIAN_KEYS = ('site', 'interval')
+
+# Inventory keys that route the SSH connection (ProxyCommand / ProxyJump in
+# an ssh_config file, or a ready socket); netmiko then opens the connection
+PROXY_KEYS = ('ssh_config_file', 'sock')
+
+# Save every fetched config to the snapshot store (off unless --keep-snapshots)
+keep_snapshots = False
+snapshot_compression = 'zlib'
+
+# Changed configs waiting for the end-of-run batch commit.
+# None means commit each device as it changes (the default).
+pending_commits = None
+
+# Diffs longer than this go to their own file under DIFF_LOG_DIR (--diff-log-limit)
+diff_log_limit = 16_000
+
+# Open sessions without netmiko's extra delays and wait on prompt patterns,
+# escalating to global_delay_factor=2 only on a timeout (off with --slow-sessions)
+fast_sessions = True
+fast_timeout = 10.0
+
+# Copy configs off the device as files where COMMANDS has a 'transfer'
+# method, falling back to the CLI (--file-transfer)
+file_transfers = False
+
+# Checkpoint journal of the current one-shot run (see run_journal.py)
+journal = None
+
+# Parsed command line the settings above were taken from (apply_options);
+# --processes workers apply the same one, so they run with every flag
+options = None
+
+# Module-level logger so helpers work when guardian is imported (e.g. benchmark.py);
+# setup_logger() attaches the handlers when run from the CLI
+logger = logging.getLogger("config_guardian")
+
 # Constants definition
 CONFIG_DIR = "configs"
-TEMP_DIR = "temp"
 LOGS_DIR = "logs"
 INVENTORY_DIR = "inventory"
 DATE_FORMAT = "%Y%m%d-%H%M%S"
+HASH_INDEX_FILE = "config_hashes.json"
+TIMINGS_FILE = "device_timings.json"
+REPORTS_DIR = "reports"
+DIFF_LOG_DIR = f"{LOGS_DIR}/diffs"
+TRANSFER_DIR = "transfers"   # spool for configs copied off devices as files
+LOG_FORMATS = ("text", "json")
+SCHEDULES = ("lpt", "inventory")
+DEFAULT_INTERVAL = 3600   # daemon: seconds between polls of one device
+KEEPALIVE_SECONDS = 30    # daemon: SSH keepalive and idle-session sweep period
+STATE_SAVE_SECONDS = 60   # daemon: how often indexes and batch commits are flushed
+STOP_CHECK_SECONDS = 1.0  # daemon: longest wait before noticing a stop signal
+ENGINES = ("threads", "pipeline", "asyncio")
+DEFAULT_CONCURRENCY = 10
+DEFAULT_QUEUE_DEPTH = 100
+PIPELINE_STOP = None  # sentinel passed down the pipeline queues
+SLOW_READ_TIMEOUT = 60    # seconds to wait for a full config on the delay-factor path
+MAX_TRANSFER_QUESTIONS = 3  # questions a transfer "prepare" command may ask in a row
+SETTLE_WORKERS = 4        # asyncio engine: threads that diff and commit collected configs
+ASYNC_READ_SIZE = 65536   # asyncio engine: characters read from the shell at a time
+# Terminal cleanup netmiko does for the other engines: line endings and ANSI codes
+LINE_ENDINGS = re.compile(r"\r\r\r\n|\r\r\n|\r\n|\n\r|\r")
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
 
 # Vendor-Specific Command Mapping
 COMMANDS = {
     'cisco_ios': {
         'running_config': 'show running-config',
         'hostname': 'show running-config | include hostname',
-        'to_find': 'hostname'
+        'to_find': 'hostname',
+        'hostname_pattern': r'^hostname\s+(\S+)',
+        'probe': 'show running-config | include Last configuration change|No configuration change',
+        'probe_marker': r'^! (Last configuration change|No configuration change).*$',
+        # fast sessions: prompt terminator after the base prompt, and the
+        # last line of a complete config
+        'prompt': r'[>#]',
+        'end_marker': r'^end$',
+        # --engine asyncio: terminal setup netmiko does on its own sessions
+        'session': ['terminal width 511', 'terminal length 0'],
+        # --file-transfer: save the config to flash, then pull it over SCP
+        # (needs `ip scp server enable`); the copy asks for the file name,
+        # and to overwrite a guardian.cfg an earlier run left behind
+        'transfer': {
+            'prepare': 'copy running-config flash:guardian.cfg',
+            'confirm': r'Destination filename \[.*\]\?|Do you want to over ?write\? \[confirm\]',
+            'protocol': 'scp',
+            'path': 'flash:guardian.cfg',
+            'cleanup': 'delete /force flash:guardian.cfg',
+        },
+        'noise': [
+            r"^Current configuration.*bytes",
+            r"^! Last configuration change.*",
+            r"^! NVRAM config last updated.*",
+            r"^Building configuration",
+        ]
     },
     'huawei_vrp': {
         'running_config': 'display current-configuration',
         'hostname': 'display current-configuration | include sysname',
-        'to_find': 'sysname'
+        'to_find': 'sysname',
+        'hostname_pattern': r'^sysname\s+(\S+)',
+        'probe': 'display current-configuration | include Last configuration was updated',
+        'probe_marker': r'^!Last configuration was updated.*$',
+        'prompt': r'[>\]]',
+        'end_marker': r'^return$',
+        'session': ['screen-length 0 temporary'],
     },
     'juniper_junos': {
         'running_config': 'show configuration',
         'hostname': 'show configuration | match host-name',
-        'to_find': 'host-name'
+        'to_find': 'host-name',
+        'hostname_pattern': r'^\s*host-name\s+(\S+)',
+        'probe': 'show configuration | match "Last commit"',
+        'probe_marker': r'^## Last commit:.*$',
+        'prompt': r'[>#%]',
+        'session': ['set cli screen-width 511', 'set cli complete-on-space off',
+                    'set cli screen-length 0'],
+        # the committed config is already a file
+        'transfer': {'protocol': 'sftp', 'path': '/config/juniper.conf.gz', 'gunzip': True},
+        'noise': [
+            r"^## Last commit:.*",    # Juniper commit timestamp
+            r"^## Last changed:.*",   # the same, in juniper.conf
+        ]
     },
     'mikrotik_routeros': {
-        'running_config': '/export'
+        # /export carries no "last changed" marker, so RouterOS is never probed
+        'running_config': '/export',
+        'hostname_pattern': r'^/system identity\s*\nset name="?([^"\n]+?)"?\s*$',
+        'prompt': r'\s*>',
+        # no paging to turn off; colours off and the terminal size go in
+        # the login name
+        'login_suffix': '+ct511w4098h',
+        'transfer': {
+            'prepare': '/export file=guardian',
+            'protocol': 'sftp',
+            'path': 'guardian.rsc',
+            'cleanup': '/file remove guardian.rsc',
+        },
+        'noise': [r"^# \w{3}/\d{2}/\d{4}"]   # Mikrotik timestamp
     }
     # Other vendors here later
 }
 
+# Volatile-line rules compiled once per vendor into a single regex; vendors
+# without their own rules (or an unknown vendor) get every vendor's rules
+ALL_NOISE = [pattern for commands in COMMANDS.values() for pattern in commands.get('noise', [])]
+NOISE = {
+    device_type: config_diff.noise_regex(commands.get('noise') or ALL_NOISE)
+    for device_type, commands in COMMANDS.items()
+}
+NOISE[None] = config_diff.noise_regex(ALL_NOISE)
+
 def safe_run(default_return=None):
     """
     Decorator to catch and log exceptions for a function,
@@ -61,10 +254,15 @@ def safe_run(default_return=None):
             except Exception as e:
                 # logs stacktrace automatically
                 logger.exception(f"[%s] error", func.__name__)
+                # kept as the failure reason of the device this thread is on
+                session.error = f"{type(e).__name__}: {e}"
                 return default_return
         return wrapper
     return decorator
 
+class TruncatedConfig(Exception):
+    """A fast-session config came back without the vendor's end-of-config marker."""
+
 class TqdmLoggingHandler(logging.Handler):
     def emit(self, record):
         try:
@@ -74,21 +272,319 @@ class TqdmLoggingHandler(logging.Handler):
         except Exception:
             self.handleError(record)
 
+class ForwardHandler(logging.Handler):
+    """Re-log records from --processes workers through this process's logger."""
+    def emit(self, record):
+        logger.handle(record)
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per record, for log shippers."""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'thread': record.threadName,
+            # QueueHandler has already folded any traceback into the message
+            'message': record.getMessage(),
+        }
+        return json.dumps(entry)
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Config guardian — backup device configs and commit changes to git."
     )
     parser.add_argument(
         "-i", "--inventory",
-        default=f"{INVENTORY_DIR}/hosts.yaml",
-        help="Path to inventory YAML file (default: inventory/hosts.yaml)"
+        nargs="+",
+        default=[f"{INVENTORY_DIR}/hosts.yaml"],
+        help="Path(s) to inventory YAML files; each file is treated as one site "
+             "unless a device sets 'site' (default: inventory/hosts.yaml)"
     )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
         help="Enable verbose console logging (DEBUG)."
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--log-format",
+        choices=LOG_FORMATS,
+        default="text",
+        help="Log file format; json writes one JSON object per line (default: text)"
+    )
+    parser.add_argument(
+        "--fast-timeout",
+        type=float,
+        default=fast_timeout,
+        help="Seconds a session waits for the prompt after the config before the "
+             f"device is retried with delay factor 2 (default: {fast_timeout:g}; "
+             "longer for devices whose last fetch took longer)"
+    )
+    parser.add_argument(
+        "--slow-sessions",
+        action="store_true",
+        help="Always use the old delay-factor-2 sessions instead of prompt-driven fast ones"
+    )
+    parser.add_argument(
+        "--file-transfer",
+        action="store_true",
+        help="Copy configs off the device as files instead of screen-scraping them "
+             "(Cisco SCP from flash, Junos juniper.conf.gz and RouterOS export over "
+             "SFTP); falls back to the CLI when a transfer fails"
+    )
+    parser.add_argument(
+        "--diff-log-limit",
+        type=int,
+        default=diff_log_limit,
+        help=f"Diffs larger than this many characters are saved to {DIFF_LOG_DIR}/ "
+             f"instead of the main log (default: {diff_log_limit})"
+    )
+    parser.add_argument(
+        "-e", "--engine",
+        choices=ENGINES,
+        default="threads",
+        help="Collection engine: 'threads' (each pool thread collects, diffs and "
+             "commits its device), 'pipeline' (SSH threads only collect while "
+             "--diff-workers processes normalize and diff and one committer thread "
+             "writes configs/ and runs git, overlapping the three stages) or "
+             "'asyncio' (one event loop keeps -c/--concurrency asyncssh sessions in "
+             "flight without a thread each, and a few threads diff and commit; "
+             "needs the asyncssh package). Default: threads"
+    )
+    parser.add_argument(
+        "-c", "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Maximum number of SSH sessions in flight (default: {DEFAULT_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--diff-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Pipeline engine: processes used for normalizing and diffing (default: CPU count)"
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=DEFAULT_QUEUE_DEPTH,
+        help=f"Pipeline engine: max configs waiting between stages (default: {DEFAULT_QUEUE_DEPTH})"
+    )
+    parser.add_argument(
+        "-b", "--batch-commit",
+        action="store_true",
+        help="Write all changed configs as one git commit at the end of the run"
+    )
+    parser.add_argument(
+        "-s", "--keep-snapshots",
+        action="store_true",
+        help="Also keep a timestamped copy of every fetched config in snapshots/"
+    )
+    parser.add_argument(
+        "--snapshot-compression",
+        choices=snapshot_store.CODECS,
+        default='zlib',
+        help="Compression for new snapshot objects (default: zlib)"
+    )
+    parser.add_argument(
+        "-p", "--probe",
+        action="store_true",
+        help="Check each device's last-change marker first and only pull the "
+             "full config when it moved (Cisco, Huawei, Junos)"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        metavar="N",
+        help="Split the inventory across N worker processes, each running its own "
+             "thread pool of --concurrency sessions; the parent does the git work"
+    )
+    parser.add_argument(
+        "-a", "--adaptive",
+        action="store_true",
+        help="One-shot runs: adapt concurrency per vendor and per site from "
+             "connect latency and failures (AIMD), capped by --concurrency"
+    )
+    parser.add_argument(
+        "--vendor-limit",
+        type=int,
+        default=4,
+        help="Adaptive mode: starting sessions per device_type (default: 4)"
+    )
+    parser.add_argument(
+        "--site-limit",
+        type=int,
+        default=4,
+        help="Adaptive mode: starting sessions per site (default: 4)"
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=SCHEDULES,
+        default="lpt",
+        help="Device order: 'lpt' runs the longest-expected devices first using "
+             "past timings, 'inventory' keeps YAML order (default: lpt)"
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="SPEC",
+        help="Only back up this node's share of the inventory: i/N, or a node name "
+             "with --shard-members. Changed configs are left uncommitted for --merge-shards"
+    )
+    parser.add_argument(
+        "--shard-members",
+        metavar="NODES",
+        help="Comma-separated node names of a sharded deployment (with --shard NAME)"
+    )
+    parser.add_argument(
+        "--merge-shards",
+        nargs="+",
+        metavar="DIR",
+        help="Merge the configs and run reports of shard working directories into "
+             "this repository as one commit, then exit"
+    )
+    parser.add_argument(
+        "-d", "--daemon",
+        action="store_true",
+        help="Keep running: hold warm SSH sessions and poll every device on its "
+             "own interval instead of doing one pass"
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=DEFAULT_INTERVAL,
+        help=f"Daemon: seconds between polls of a device; a device may set its own "
+             f"'interval' in the inventory (default: {DEFAULT_INTERVAL})"
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.1,
+        help="Daemon: random spread applied to each interval, as a fraction (default: 0.1)"
+    )
+    parser.add_argument(
+        "--syslog-port",
+        type=int,
+        help="Daemon: listen for syslog on this UDP/TCP port and back up a device "
+             "as soon as it reports a config change (use --interval 0 for events only)"
+    )
+    parser.add_argument(
+        "--syslog-bind",
+        default="0.0.0.0",
+        help="Daemon: address the syslog listener binds to (default: 0.0.0.0)"
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=5.0,
+        help="Daemon: seconds of quiet after a change message before backing up (default: 5)"
+    )
+    parser.add_argument(
+        "--report-dir",
+        default=REPORTS_DIR,
+        help=f"Directory for the per-run JSON timing report (default: {REPORTS_DIR})"
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Also write Prometheus metrics to this file, e.g. the node_exporter "
+             "textfile directory (guardian.prom)"
+    )
+    parser.add_argument(
+        "--compliance",
+        metavar="RULES",
+        help="After the run, check the stored configs against this YAML rule pack "
+             "(see compliance.py); only changed configs are re-evaluated"
+    )
+    parser.add_argument(
+        "--precheck",
+        action="store_true",
+        help="Probe every device's SSH port over TCP before the run and skip the "
+             "ones that do not answer; repeat offenders are skipped unprobed for "
+             f"a cooldown (state in {reachability.HEALTH_FILE})"
+    )
+    parser.add_argument(
+        "--precheck-timeout",
+        type=float,
+        default=3.0,
+        help="Pre-check: seconds to wait for each TCP connect (default: 3)"
+    )
+    parser.add_argument(
+        "--precheck-retries",
+        type=int,
+        default=2,
+        help="Pre-check: retries with exponential backoff before a device is "
+             "skipped (default: 2)"
+    )
+    parser.add_argument(
+        "--breaker-cooldown",
+        type=int,
+        default=900,
+        help="Pre-check: seconds a device that failed is skipped without probing; "
+             "doubles with each consecutive failure (default: 900)"
+    )
+    catch_up = parser.add_mutually_exclusive_group()
+    catch_up.add_argument(
+        "--resume",
+        action="store_true",
+        help=f"Finish the last run from {run_journal.JOURNAL_FILE}: only devices it "
+             f"never reached or that failed"
+    )
+    catch_up.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Only retry the devices that failed in the last run"
+    )
+    args = parser.parse_args()
+    if args.syslog_port and not args.daemon:
+        parser.error("--syslog-port needs --daemon")
+    if args.daemon and (args.resume or args.retry_failed or args.precheck or args.adaptive):
+        parser.error("--resume/--retry-failed/--precheck/--adaptive only apply to one-shot runs")
+    if args.processes is not None:
+        if args.processes < 1:
+            parser.error("--processes must be at least 1")
+        if args.daemon or args.adaptive or args.engine != "threads":
+            parser.error("--processes works with one-shot threads runs, "
+                         "without --adaptive or --daemon")
+    if args.engine == "asyncio":
+        if asyncssh is None:
+            parser.error("--engine asyncio needs the asyncssh package")
+        if args.file_transfer or args.adaptive or args.daemon:
+            parser.error("--engine asyncio reads configs over the CLI in one-shot runs, "
+                         "without --file-transfer, --adaptive or --daemon")
+    if args.shard_members and not args.shard:
+        parser.error("--shard-members needs --shard")
+    if args.merge_shards and (args.shard or args.daemon):
+        parser.error("--merge-shards can't be combined with --shard or --daemon")
+    args.shard_nodes = None
+    if args.shard:
+        try:
+            args.shard_nodes = sharding.parse_shard(args.shard, args.shard_members)
+        except ValueError as e:
+            parser.error(f"--shard: {e}")
+    if args.compliance:
+        # a broken rule pack should stop the run before any device is touched
+        try:
+            compliance.load_pack(args.compliance)
+        except (OSError, ValueError, re.error, yaml.YAMLError) as e:
+            parser.error(f"--compliance {args.compliance}: {e}")
+    return args
+
+def apply_options(args):
+    """
+    Set the module settings from the parsed command line. main() and every
+    --processes worker call this with the same `args`, so a new flag only
+    needs handling here.
+    """
+    global options, keep_snapshots, snapshot_compression, probe_changes, metrics_file
+    global diff_log_limit, compliance_rules, shard_node, fast_sessions, fast_timeout, file_transfers
+    options = args
+    keep_snapshots = args.keep_snapshots
+    snapshot_compression = args.snapshot_compression
+    probe_changes = args.probe
+    metrics_file = args.metrics_file
+    compliance_rules = args.compliance
+    shard_node = args.shard_nodes[0] if args.shard_nodes else None
+    diff_log_limit = args.diff_log_limit
+    fast_sessions = not args.slow_sessions
+    fast_timeout = args.fast_timeout
+    file_transfers = args.file_transfer
 
 def setup_logger(
     name="config_guardian",
@@ -96,8 +592,13 @@ def setup_logger(
     file_level=logging.DEBUG,        # log file level (captures everything)
     console_level=logging.INFO,      # console level (default INFO)
     max_bytes=5_000_000,
-    backup_count=5
+    backup_count=5,
+    log_format="text"
 ):
+    """
+    Worker threads only put records on a queue; a single listener thread
+    does the file writes and tqdm redraws, so log I/O never blocks them.
+    """
     logger = logging.getLogger(name)
 
     # ensure logger root level allows handlers to filter
@@ -108,223 +609,1780 @@ def setup_logger(
 
         # rotating file handler (captures file_level and above)
         fh = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
-        fh.setFormatter(fmt)
+        fh.setFormatter(JsonLinesFormatter() if log_format == "json" else fmt)
         fh.setLevel(file_level)
-        logger.addHandler(fh)
 
         # console handler replaced with tqdm-safe handler
         ch = TqdmLoggingHandler()
         ch.setFormatter(fmt)
         ch.setLevel(console_level)
-        logger.addHandler(ch)
 
-    logger.info("\nLog file is saving to %s\n", log_file)
+        log_queue = queue.SimpleQueue()
+        qh = QueueHandler(log_queue)
+        qh.setLevel(min(file_level, console_level))
+        logger.addHandler(qh)
+
+        listener = QueueListener(log_queue, fh, ch, respect_handler_level=True)
+        listener.start()
+        # drain whatever is still queued when the process exits
+        atexit.register(listener.stop)
+
+        logger.info("\nLog file is saving to %s\n", log_file)
     return logger
 
 @safe_run(default_return=(None, None, None))
 def get_device_config(device):
     """
     Connect to a device and return (hostname, running_config, ssh_connection).
-    Handles banners and long outputs gracefully.
+    A fast session that times out (or truncates the config) is retried once
+    on the delay-factor path.
+    """
+    ssh = None
+    try:
+        ssh = open_session(device, slow=not fast_sessions)
+        hostname, running_config = read_config(ssh, device)
+    except (ReadTimeout, TruncatedConfig) as e:
+        if not fast_sessions:
+            raise
+        if ssh:
+            disconnect_device(ssh)
+        logger.warning("Fast session to %s failed (%s), retrying with delay factor 2",
+                       device['host'], str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__)
+        ssh = open_session(device, slow=True)
+        hostname, running_config = read_config(ssh, device)
+    return (hostname, running_config, ssh)
+
+def open_session(device, slow=False, **options):
     """
-    # Increase delay factor to handle slow/long-running commands
-    ssh = ConnectHandler(**device, global_delay_factor=2)
+    Connect (and enable where needed); extra options go to ConnectHandler.
+    :param slow: use global_delay_factor=2 and let netmiko find the prompt
+                 before every command, for devices too slow for fast sessions
+    """
+    # Open the TCP connection ourselves so it is timed apart from SSH auth,
+    # unless the device is reached through a proxy
+    start = time.monotonic()
+    with timed("tcp_connect"):
+        sock = open_socket(device)
+    if sock:
+        options['sock'] = sock
+    if slow:
+        # Increase delay factor to handle slow/long-running commands
+        options['global_delay_factor'] = 2
+    try:
+        with timed("ssh_auth"):
+            ssh = ConnectHandler(**connection_params(device), **options)
+    except Exception:
+        if sock:
+            sock.close()
+        raise
+    session.connect_time = time.monotonic() - start
     logger.info("Connected to %s", device['host'])
+    base_prompt = getattr(ssh, 'base_prompt', None)
+    ssh.guardian_prompt = None if slow else prompt_pattern(base_prompt, device['device_type'])
 
     # Cisco needs enable
     if device['device_type'] == 'cisco_ios':
-        ssh.enable()
+        with timed("enable"):
+            ssh.enable()
+    return ssh
+
+def prompt_pattern(base_prompt, device_type):
+    """
+    expect_string for a fast session: this session's prompt at the very end
+    of the output, so a command returns as soon as the prompt is back.
+    """
+    terminator = COMMANDS.get(device_type, {}).get('prompt')
+    if not terminator or not base_prompt:
+        return None
+    return rf"{re.escape(base_prompt)}{terminator}\s*$"
+
+def send_command(ssh, command, read_timeout=10.0):
+    """Run a command, waiting on the prompt pattern when the session has one."""
+    pattern = getattr(ssh, 'guardian_prompt', None)
+    if pattern:
+        return ssh.send_command(command, expect_string=pattern, read_timeout=read_timeout)
+    return ssh.send_command(command, read_timeout=read_timeout)
+
+def fetch_timeout(device):
+    """
+    How long a fast session waits for the full config before escalating:
+    --fast-timeout, or three times the device's last fetch if that was longer.
+    """
+    with timings_lock:
+        last_fetch = device_timings.get(device['host'], {}).get('phases', {}).get('fetch', 0.0)
+    return min(SLOW_READ_TIMEOUT, max(fast_timeout, 3 * last_fetch))
 
+def open_socket(device):
+    """
+    Direct TCP connection to the device, or None when one of PROXY_KEYS
+    applies and netmiko/paramiko must connect through the jump host.
+    """
+    if any(device.get(key) for key in PROXY_KEYS):
+        return None
+    return socket.create_connection(
+        (device['host'], device.get('port', 22)), timeout=device.get('conn_timeout', 10)
+    )
+
+def read_config(ssh, device):
+    """
+    Pull the running config over an open session.
+    Returns (hostname, running_config); running_config is PROBE_UNCHANGED
+    when the change probe shows nothing new.
+    """
     # Determine commands for this vendor
     device_type = device.get('device_type', 'unknown')
     run_cmd = COMMANDS.get(device_type, {}).get('running_config')
 
-    # Safely run the main config command with longer timeout
-    running_config = ssh.send_command(run_cmd, read_timeout=60)
+    # Skip the full transfer when the device's own "last change" marker
+    # still matches the one recorded with our backup
+    if probe_changes:
+        known = known_probe(device['host'])
+        if known:
+            with timed("probe"):
+                marker = probe_device(ssh, device_type)
+            if marker == known[1]:
+                return (known[0], PROBE_UNCHANGED)
 
-    # Hostname extraction
-    if device_type != 'mikrotik_routeros':
-        host_cmd = COMMANDS.get(device_type, {}).get('hostname')
-        to_find = COMMANDS.get(device_type, {}).get('to_find')
+    if file_transfers and COMMANDS.get(device_type, {}).get('transfer'):
+        try:
+            return transfer_config(ssh, device)
+        except (OSError, EOFError, zlib.error, paramiko.SSHException, ReadTimeout,
+                file_transfer.TransferError) as e:
+            logger.warning("File transfer from %s failed (%s), reading the config over the CLI",
+                           device['host'], str(e) or type(e).__name__)
 
-        raw_hostname = ssh.send_command(host_cmd)
+    # Fast sessions return as soon as the prompt is back; the slow path
+    # gets the long timeout
+    fast = getattr(ssh, 'guardian_prompt', None) is not None
+    with timed("fetch"):
+        running_config = send_command(ssh, run_cmd, fetch_timeout(device) if fast else SLOW_READ_TIMEOUT)
+    end_marker = COMMANDS.get(device_type, {}).get('end_marker')
+    if fast and end_marker and not re.search(end_marker, running_config[-4096:], re.MULTILINE):
+        raise TruncatedConfig(f"no {end_marker!r} line at the end of the config")
 
-        # Pick only the line containing the keyword
-        lines = [l for l in raw_hostname.splitlines() if to_find in l]
-        if lines:
-            clean_line = lines[-1]  # Last matching line usually has the real name
-            # Try regex first
-            match = re.search(rf"{to_find}\s+(\S+)", clean_line)
-            if match:
-                hostname = match.group(1)
-            else:
-                hostname = clean_line.replace(to_find, "").strip().replace(";", "")
-        else:
-            # Fallback to IP/host if we didn't match anything
-            hostname = device['host']
-    else:
-        # Mikrotik prompt looks like: [user@hostname] >
-        raw_value = f"[{device['username']}@"
-        prompt = ssh.find_prompt()
-        hostname = (
-            prompt.replace("] >", "").strip().replace(raw_value, "").strip()
-        )
+    # Hostname extraction: read it from the config we already have and
+    # only spend another round trip when that fails
+    hostname = parse_hostname(device_type, running_config)
+    if not hostname:
+        with timed("hostname"):
+            hostname = fetch_hostname(ssh, device)
 
-    return (hostname, running_config, ssh)
+    return (hostname, running_config)
 
-@safe_run(default_return=(None, None, None))
-def save_temp_config(hostname, running_config):
+def transfer_config(ssh, device):
     """
-    Saves configuration temporarily to /temp and
-    returns the path
+    Copy the config off the device as a file with the vendor's COMMANDS
+    'transfer' method. The file is streamed to TRANSFER_DIR and hashed on
+    the way; the normalized hash is left in session.digest. Returns
+    (hostname, running_config), with PROBE_UNCHANGED when the hash matches
+    the stored backup.
     """
-    # Set filename and directory
-    config_file = f"{CONFIG_DIR}/{hostname}.cfg"
-    # Create a timestamp for the temp file (YYYYMMDD-HHMMSS)
-    timestamp = datetime.now().strftime(DATE_FORMAT)
-    temp_file = f"{TEMP_DIR}/{hostname}_{timestamp}.cfg"
+    device_type = device['device_type']
+    method = COMMANDS[device_type]['transfer']
+    os.makedirs(TRANSFER_DIR, exist_ok=True)
+    local_file = f"{TRANSFER_DIR}/{device['host']}"
+    try:
+        if method.get('prepare'):
+            with timed("prepare"):
+                prepare_transfer(ssh, method)
+        with timed("transfer"):
+            digest, size = file_transfer.fetch(
+                ssh.remote_conn.get_transport(), method['protocol'], method['path'], local_file,
+                gunzip=method.get('gunzip', False), noise=NOISE.get(device_type, NOISE[None]),
+                timeout=SLOW_READ_TIMEOUT
+            )
+    finally:
+        if method.get('cleanup'):
+            send_command(ssh, method['cleanup'])
+    logger.debug("Transferred %d bytes from %s over %s", size, device['host'], method['protocol'])
+
+    try:
+        # an unchanged config is never read into memory
+        with hash_lock:
+            known = hostnames_by_host.get(device['host'])
+        if known and digest == indexed_hash(known, f"{CONFIG_DIR}/{known}.cfg"):
+            return (known, PROBE_UNCHANGED)
+
+        # the text the hasher saw: no newline translation, and no final
+        # line break, like the CLI output
+        with open(local_file, 'r', encoding='utf-8', errors='replace', newline='') as f:
+            running_config = file_transfer.chomp(f.read())
+    finally:
+        os.remove(local_file)
+    session.digest = digest
+
+    hostname = parse_hostname(device_type, running_config)
+    if not hostname:
+        with timed("hostname"):
+            hostname = fetch_hostname(ssh, device)
+    return (hostname, running_config)
+
+def prepare_transfer(ssh, method):
+    """
+    Run the command that writes the config to a file on the device,
+    answering every 'confirm' question (destination name, overwrite) with
+    Enter. A question nobody expected is cancelled with Ctrl+C before the
+    ReadTimeout goes up, so the session is back at its prompt for the CLI.
+    """
+    prompt = getattr(ssh, 'guardian_prompt', None) or re.escape(ssh.base_prompt)
+    confirm = method.get('confirm')
+    expect = f"{confirm}|{prompt}" if confirm else prompt
+    try:
+        output = ssh.send_command(method['prepare'], expect_string=expect, read_timeout=SLOW_READ_TIMEOUT)
+        for _ in range(MAX_TRANSFER_QUESTIONS):
+            if not (confirm and re.search(confirm, output)):
+                break
+            output = ssh.send_command("\n", expect_string=expect, read_timeout=SLOW_READ_TIMEOUT,
+                                      cmd_verify=False)
+    except ReadTimeout:
+        ssh.write_channel("\x03")
+        ssh.read_until_pattern(prompt, read_timeout=fast_timeout)
+        raise
+
+def connection_params(device):
+    """Inventory entry minus the keys that are only meaningful to guardian."""
+    return {k: v for k, v in device.items() if k not in GUARDIAN_KEYS}
+
+def parse_hostname(device_type, running_config):
+    """
+    Pull hostname/sysname/host-name/identity out of a fetched config.
+    Returns None when the vendor has no pattern or the line is missing.
+    """
+    pattern = COMMANDS.get(device_type, {}).get('hostname_pattern')
+    if not pattern or not running_config:
+        return None
+    match = re.search(pattern, running_config, re.MULTILINE)
+    return match.group(1) if match else None
+
+def fetch_hostname(ssh, device):
+    """
+    Ask the device for its hostname (extra command, or the prompt on Mikrotik).
+    """
+    device_type = device.get('device_type', 'unknown')
+    if device_type == 'mikrotik_routeros':
+        return hostname_from_prompt(device, ssh.find_prompt())
+    return hostname_from_output(device, send_command(ssh, COMMANDS.get(device_type, {}).get('hostname')))
+
+def hostname_from_output(device, raw_hostname):
+    """Hostname in the output of the vendor's 'hostname' command."""
+    to_find = COMMANDS.get(device.get('device_type', 'unknown'), {}).get('to_find')
 
-    # Save running-config to file
-    with open(temp_file, 'w') as f:
-        f.write(running_config)
-    logger.info("Saved running-config temporarily to %s", temp_file)
-    return (temp_file, config_file, timestamp)
+    # Pick only the line containing the keyword
+    lines = [l for l in raw_hostname.splitlines() if to_find in l]
+    if lines:
+        clean_line = lines[-1]  # Last matching line usually has the real name
+        # Try regex first
+        match = re.search(rf"{to_find}\s+(\S+)", clean_line)
+        if match:
+            return match.group(1)
+        return clean_line.replace(to_find, "").strip().replace(";", "")
+    # Fallback to IP/host if we didn't match anything
+    return device['host']
+
+def hostname_from_prompt(device, prompt):
+    """Hostname in a Mikrotik prompt, which looks like: [user@hostname] >"""
+    raw_value = f"[{device['username']}@"
+    return prompt.replace("] >", "").strip().replace(raw_value, "").strip()
+
+@safe_run()
+def save_snapshot(hostname, running_config, digest=None, device_type=None):
+    """
+    Keep a point-in-time copy in the content-addressed snapshot store.
+    Identical configs are only stored once, and a config whose normalized
+    hash (`digest`, computed here when not given) has not changed adds no
+    snapshot.
+    """
+    digest = digest or config_hash(running_config, device_type)
+    snapshot_store.put(hostname, running_config, compression=snapshot_compression, normalized=digest)
 
 @safe_run()
-def update_and_commit(config_file, temp_file, hostname, timestamp):
-    # Handle diff, copy, and git commit
+def update_and_commit(hostname, running_config, digest=None, device_type=None):
+    """
+    Compare the in-memory running config with the stored one and only
+    touch configs/ (and git) when something changed.
+    """
+    config_file = f"{CONFIG_DIR}/{hostname}.cfg"
+    if keep_snapshots:
+        save_snapshot(hostname, running_config, digest, device_type)
+
+    # Same normalized hash as last time: nothing to diff
+    known_hash = indexed_hash(hostname, config_file)
+    if digest and digest == known_hash:
+        record_hash(hostname, digest, config_file)
+        session.outcome = "unchanged"
+        logger.info("No changes detected")
+        return True
+
     if os.path.exists(config_file):
-        diff_output = compare_configs(config_file, temp_file)
-        if diff_output:
-            logger.warning("CHANGE DETECTED for %s", hostname)
-            logger.debug("\n%s", diff_output)
-            shutil.copy(temp_file, config_file)
-            logger.info(f"Updated {config_file} for {hostname}")
-            
-            # Commit changes to git
-            commit_changes(config_file, hostname, timestamp)
-        else:
-            logger.info("No changes detected")
+        with timed("diff"):
+            diff_output = compare_running_config(config_file, running_config, device_type)
     else:
+        diff_output = None
+    with timed("sections"):
+        sections = section_changes(hostname, running_config, device_type, known_hash, digest)
+    store_config(hostname, running_config, diff_output, digest, sections)
+    return True
+
+def store_config(hostname, running_config, diff_output, digest=None, sections=None):
+    """
+    Handle write and git commit for a compared config.
+    :param diff_output: None on first run, '' when unchanged, else the diff
+    :param sections: names of the changed config blocks, when known
+    """
+    config_file = f"{CONFIG_DIR}/{hostname}.cfg"
+    timestamp = datetime.now().strftime(DATE_FORMAT)
+
+    if diff_output is None:
         # First time: just save directly
-        shutil.copy(temp_file, config_file)
+        with timed("write"):
+            write_config(config_file, running_config)
+        session.outcome = "first_run"
         logger.info(f"First run – saved initial backup to {config_file}")
+    elif diff_output:
+        session.sections = sections
+        if sections:
+            logger.warning("CHANGE DETECTED for %s in %s", hostname, ", ".join(sections))
+        else:
+            logger.warning("CHANGE DETECTED for %s", hostname)
+        log_diff(hostname, diff_output, timestamp)
+        with timed("write"):
+            write_config(config_file, running_config)
+        logger.info(f"Updated {config_file} for {hostname}")
+
+        # Commit changes to git
+        session.committed = commit_changes(config_file, hostname, timestamp)
+        session.outcome = "changed"
+    else:
+        session.outcome = "unchanged"
+        logger.info("No changes detected")
+
+    if digest:
+        record_hash(hostname, digest, config_file)
+
+@safe_run()
+def section_changes(hostname, running_config, device_type=None, old_digest=None, digest=None):
+    """
+    Build and cache the section tree of the new config and compare it with
+    the stored config's tree (cached, or rebuilt from configs/ when the
+    cache is stale). Returns the changed block names, or None without an
+    earlier config.
+    """
+    config_file = f"{CONFIG_DIR}/{hostname}.cfg"
+    old_tree = config_tree.load_tree(hostname, old_digest)
+    if old_tree is None and os.path.exists(config_file):
+        with open(config_file, 'r') as f:
+            old_tree = config_tree.build_tree(clean_config_lines(f.readlines(), device_type), device_type)
+
+    new_lines = clean_config_lines(running_config.splitlines(), device_type)
+    new_tree = config_tree.build_tree(new_lines, device_type)
+    if digest:
+        config_tree.save_tree(hostname, digest, new_tree)
+    return config_tree.changed_sections(old_tree, new_tree) if old_tree else None
+
+def log_diff(hostname, diff_output, timestamp):
+    """
+    Log a diff at DEBUG; one over diff_log_limit goes to its own file under
+    DIFF_LOG_DIR and the main log only gets a pointer to it.
+    """
+    if len(diff_output) <= diff_log_limit:
+        logger.debug("\n%s", diff_output)
+        return
+    os.makedirs(DIFF_LOG_DIR, exist_ok=True)
+    diff_file = f"{DIFF_LOG_DIR}/{hostname}_{timestamp}.diff"
+    with open(diff_file, 'w') as f:
+        f.write(diff_output)
+    logger.debug("Diff for %s (%d lines) saved to %s",
+                 hostname, diff_output.count("\n"), diff_file)
+
+def write_config(config_file, running_config):
+    """Write atomically so a crash never leaves a half-written backup."""
+    atomic_file.atomic_write(config_file, running_config)
+
+def change_marker(device_type, text):
+    """Return the vendor's "last configuration change" line from text, or None."""
+    pattern = COMMANDS.get(device_type, {}).get('probe_marker')
+    if not pattern:
+        return None
+    match = re.search(pattern, text, re.MULTILINE)
+    return match.group(0).strip() if match else None
+
+def probe_device(ssh, device_type):
+    """Run the short per-vendor probe command and return its marker."""
+    probe_cmd = COMMANDS.get(device_type, {}).get('probe')
+    if not probe_cmd:
+        return None
+    return change_marker(device_type, send_command(ssh, probe_cmd))
+
+def known_probe(host):
+    """
+    Return (hostname, marker) recorded for a device address, or None when
+    there is no marker or the stored backup can't be trusted.
+    """
+    with hash_lock:
+        hostname = hostnames_by_host.get(host)
+        entry = config_hashes.get(hostname, {})
+    if not entry.get('probe'):
+        return None
+    if not indexed_hash(hostname, f"{CONFIG_DIR}/{hostname}.cfg"):
+        return None
+    return (hostname, entry['probe'])
+
+def record_probe(hostname, device, running_config):
+    """Remember the marker of a config that has just been stored."""
+    marker = change_marker(device.get('device_type'), running_config)
+    with hash_lock:
+        entry = config_hashes.setdefault(hostname, {})
+        entry['host'] = device['host']
+        entry['device_type'] = device.get('device_type')
+        entry['probe'] = marker
+        hostnames_by_host[device['host']] = hostname
+
+def touch_hash(hostname):
+    with hash_lock:
+        config_hashes[hostname]['last_seen'] = datetime.now().strftime(DATE_FORMAT)
+
+def config_hash(running_config, device_type=None):
+    """SHA-256 of the normalized config, computed in memory."""
+    lines = clean_config_lines(running_config.splitlines(keepends=True), device_type)
+    return hashlib.sha256(''.join(lines).encode()).hexdigest()
+
+def indexed_hash(hostname, config_file):
+    """
+    Return the indexed hash for a device, or None when the index can't be
+    trusted (no entry, or the stored file is missing or changed size).
+    """
+    with hash_lock:
+        entry = config_hashes.get(hostname, {})
+    if not entry.get('sha256') or not os.path.exists(config_file):
+        return None
+    if os.path.getsize(config_file) != entry['size']:
+        return None
+    return entry['sha256']
+
+def record_hash(hostname, digest, config_file):
+    with hash_lock:
+        config_hashes.setdefault(hostname, {}).update({
+            'sha256': digest,
+            'size': os.path.getsize(config_file),
+            'last_seen': datetime.now().strftime(DATE_FORMAT)
+        })
+
+@safe_run()
+def load_hash_index():
+    if os.path.exists(HASH_INDEX_FILE):
+        with open(HASH_INDEX_FILE, 'r') as f:
+            config_hashes.update(json.load(f))
+    for hostname, entry in config_hashes.items():
+        if entry.get('host'):
+            hostnames_by_host[entry['host']] = hostname
+
+@safe_run()
+def save_hash_index():
+    with hash_lock:
+        with atomic_file.atomic_open(HASH_INDEX_FILE) as f:
+            json.dump(config_hashes, f, indent=2, sort_keys=True)
 
 @safe_run(default_return=[])
-def clean_config_lines(lines):
+def clean_config_lines(lines, device_type=None):
     """
     Remove volatile lines from configs (Cisco, Mikrotik, Juniper…)
     so diffs only show real changes.
     """
-    NOISE_PATTERNS = [
-        r"^Current configuration.*bytes",
-        r"^! Last configuration change.*",
-        r"^! NVRAM config last updated.*",
-        r"^Building configuration",
-        r"^# \w{3}/\d{2}/\d{4}",          # Mikrotik timestamp
-        r"^## Last commit:.*"             # Juniper commit timestamp
-    ]
-    return [
-        l for l in lines
-        if not any(re.match(p, l) for p in NOISE_PATTERNS)
-    ]
+    return config_diff.clean_lines(lines, NOISE.get(device_type, NOISE[None]))
 
-@safe_run(default_return='')
-def compare_configs(old_file, new_file):
+def diff_config_lines(old_lines, new_lines, fromfile, tofile, device_type=None):
     """
-    Compare two configuration files and return their diff output.
-    :param old_file: Path to the old config file
-    :param new_file: Path to the new config file
-    :return: String containing the unified diff
+    Normalize both sides and return their unified diff as one string.
     """
-    # Read old file
-    with open(old_file, 'r') as f:
-        old_lines = f.readlines()
-    
-    # Read new file
-    with open(new_file, 'r') as f:
-        new_lines = f.readlines()
+    old_clean = clean_config_lines(old_lines, device_type)
+    new_clean = clean_config_lines(new_lines, device_type)
 
-    old_clean = clean_config_lines(old_lines)
-    new_clean = clean_config_lines(new_lines)
-
-    # Generate unified diff
-    diff = difflib.unified_diff(
-        old_clean,
-        new_clean,
-        fromfile=old_file,
-        tofile=new_file,
-        lineterm=''  # avoid extra newlines
-    )
+    # Generate unified diff (patience diff, stays fast on 100k+ line configs)
+    diff = config_diff.unified_diff(old_clean, new_clean, fromfile=fromfile, tofile=tofile)
 
     # Join into one string
     return '\n'.join(diff)
 
+@safe_run(default_return='')
+def compare_running_config(config_file, running_config, device_type=None):
+    """
+    Compare the stored config file with a running config held in memory.
+    :return: String containing the unified diff
+    """
+    with open(config_file, 'r') as f:
+        old_lines = f.readlines()
+    new_lines = running_config.splitlines(keepends=True)
+    return diff_config_lines(old_lines, new_lines, config_file, f"{config_file} (running)", device_type)
+
 @safe_run() 
 def commit_changes(filename, hostname, detect_time):
     """
     Stage and commit a file to Git with a message containing the hostname.
+    In batch mode the change is queued for commit_batch() instead.
+    Returns True once committed.
     :param filename: Path to the file to commit
     :param hostname: Device hostname to include in commit message
     """
+    if worker_events is not None:
+        # the parent commits; it tells the journal whether that worked
+        worker_events.put(("commit", filename, hostname, detect_time))
+        return
+    if shard_node is not None:
+        logger.info(f"Shard {shard_node}: {filename} left for the shard merge")
+        return
     # only one thread in here at a time to avoid git index lock
     with git_lock:
-        subprocess.run(["git", "add", filename], check=True)
-        commit_message = f"Config change detected on {hostname} at {detect_time}"
-        subprocess.run(["git", "commit", "-m", commit_message], check=True)
+        if pending_commits is not None:
+            pending_commits.append((filename, hostname, detect_time))
+            logger.info(f"Queued {filename} for the batch commit")
+            return
+        with timed("commit"):
+            subprocess.run(["git", "add", filename], check=True)
+            commit_message = f"Config change detected on {hostname} at {detect_time}"
+            subprocess.run(["git", "commit", "-m", commit_message], check=True)
         logger.info(f"Committed {filename} to git with message: '{commit_message}'")
+        count_commits([hostname])
+        return True
+
+def git(*args, stdin=None):
+    """Run a git command and return its stripped stdout."""
+    result = subprocess.run(
+        ["git", *args], input=stdin, capture_output=True, text=True, check=True
+    )
+    return result.stdout.strip()
+
+def write_tree(base_tree, path, blobs):
+    """
+    Return a new tree id: `base_tree` with `blobs` ({filename: blob id})
+    written under the directory `path` (a list of path components).
+    Only the trees along `path` are rewritten, with one ls-tree and one
+    mktree per level, however many blobs change.
+    """
+    entries = {}
+    if base_tree:
+        for line in git("ls-tree", "-z", "--full-tree", base_tree).split("\0"):
+            if line:
+                meta, name = line.split("\t", 1)
+                entries[name] = meta
+
+    if path:
+        child = entries.get(path[0])
+        child_tree = child.split()[2] if child and child.split()[1] == "tree" else None
+        entries[path[0]] = f"040000 tree {write_tree(child_tree, path[1:], blobs)}"
+    else:
+        for name, blob in blobs.items():
+            entries[name] = f"100644 blob {blob}"
+
+    listing = "".join(f"{meta}\t{name}\0" for name, meta in sorted(entries.items()))
+    return git("mktree", "-z", stdin=listing)
+
+@safe_run()
+def commit_batch(changes):
+    """
+    Commit every queued config as a single commit using git plumbing
+    (hash-object/mktree/commit-tree), so no per-device add/commit runs.
+    :param changes: list of (filename, hostname, detect_time)
+    Returns True once the changes are committed.
+    """
+    if not changes:
+        logger.info("Batch commit: no changed configs to commit")
+        return True
+
+    with git_lock:
+        # later entries win if a device was queued twice
+        files = {filename: (hostname, detect_time) for filename, hostname, detect_time in changes}
+        blob_ids = git("hash-object", "-w", "--", *files).splitlines()
+
+        prefix = git("rev-parse", "--show-prefix")
+        blobs_by_dir = {}
+        for filename, blob in zip(files, blob_ids):
+            directory, name = os.path.split(os.path.normpath(filename))
+            repo_dir = os.path.normpath(os.path.join(prefix, directory))
+            blobs_by_dir.setdefault(repo_dir, {})[name] = blob
+
+        try:
+            parent = git("rev-parse", "--verify", "-q", "HEAD")
+        except subprocess.CalledProcessError:
+            parent = None  # empty repository, this is the root commit
+        tree = git("rev-parse", f"{parent}^{{tree}}") if parent else None
+        for repo_dir, blobs in blobs_by_dir.items():
+            path = [] if repo_dir == "." else repo_dir.split(os.sep)
+            tree = write_tree(tree, path, blobs)
+
+        lines = [f"Config changes detected on {len(files)} devices", ""]
+        lines += [
+            f"- {hostname} at {detect_time} ({filename})"
+            for filename, (hostname, detect_time) in files.items()
+        ]
+        commit_message = "\n".join(lines)
+        parent_args = ["-p", parent] if parent else []
+        commit = git("commit-tree", tree, *parent_args, stdin=commit_message)
+
+        if parent:
+            git("update-ref", "-m", "guardian: batch commit", "HEAD", commit, parent)
+        else:
+            git("update-ref", "-m", "guardian: batch commit", "HEAD", commit)
+        # one index refresh for the committed paths so `git status` stays clean
+        git("reset", "-q", "HEAD", "--", *files)
+        logger.info(f"Committed {len(files)} changed configs to git as {commit[:12]}")
+    count_commits([hostname for hostname, _ in files.values()])
+    return True
+
+def count_commits(hostnames):
+    """Remember committed changes by device type for the metrics textfile."""
+    if not metrics_file:
+        return
+    with hash_lock:
+        device_types = [config_hashes.get(hostname, {}).get('device_type') or 'unknown'
+                        for hostname in hostnames]
+    with timings_lock:
+        committed_changes.extend(device_types)
 
 @safe_run()
 def disconnect_device(ssh):
     # Disconnect from device
     ssh.disconnect()
 
-def process_device(device):
-    hostname, running_config, ssh = get_device_config(device)
-    if hostname and running_config:
-        temp_file, config_file, timestamp = save_temp_config(hostname, running_config)
-        update_and_commit(config_file, temp_file, hostname, timestamp)
-        disconnect_device(ssh)
+@contextmanager
+def timed(phase, phases=None):
+    """
+    Add the time spent in the block to this thread's current device.
+    :param phases: dict to add to instead (asyncio coroutines share one thread)
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if phases is None:
+            phases = session.__dict__.setdefault('phases', {})
+        phases[phase] = phases.get(phase, 0.0) + time.monotonic() - start
+
+def track_device_time(func):
+    """
+    Decorator for per-device workers: times the whole call and keeps the
+    per-phase breakdown collected by timed() in device_timings, plus the
+    outcome in run_records for the run report.
+    """
+    @wraps(func)
+    def wrapper(device, *args, **kwargs):
+        start_device()
+        start = time.monotonic()
+        try:
+            return func(device, *args, **kwargs)
+        finally:
+            finish_device(device, time.monotonic() - start)
+    return wrapper
+
+def start_device():
+    """Clear this thread's session facts before it works on a device."""
+    session.phases = {}
+    session.hostname = session.outcome = session.sections = None
+    session.error = session.committed = session.digest = None
+
+def finish_device(device, total):
+    """
+    Keep the device's phase timings in device_timings and its outcome in
+    run_records, and journal it.
+    :param total: seconds spent on the device
+    """
+    phases = {k: round(v, 3) for k, v in session.phases.items()}
+    with timings_lock:
+        device_timings[device['host']] = {
+            'device_type': device.get('device_type', 'unknown'),
+            'phases': phases,
+            'total': round(total, 3),
+            'last_run': datetime.now().strftime(DATE_FORMAT)
+        }
+        record = run_records[device['host']] = {
+            'host': device['host'],
+            'hostname': session.hostname,
+            'device_type': device.get('device_type', 'unknown'),
+            'site': device.get('site', 'default'),
+            'outcome': session.outcome or "failed",
+            'sections': session.sections,
+            'phases': dict(phases),
+            'total': round(total, 3)
+        }
+    # the pipeline's commit stage journals the device once it settles
+    if record['outcome'] != "collected":
+        journal_device(record)
+
+def journal_device(record, reason=None):
+    """Checkpoint a device's final outcome (and why it failed) in the run journal."""
+    if record['outcome'] == "failed":
+        reason = reason or session.error or "connection/config failed"
+    if worker_events is not None:
+        worker_events.put(("device", record, reason))
+        return
+    if journal is None:
+        return
+    committed = bool(session.committed) if record['outcome'] == "changed" else None
+    journal.device(record['host'], record['hostname'], record['outcome'], reason, committed)
+
+def skip_device(device, reason):
+    """Account for a device the pre-check kept away from the SSH workers."""
+    logger.info("Skipping %s: %s", device['host'], reason)
+    record = {
+        'host': device['host'],
+        'hostname': None,
+        'device_type': device.get('device_type', 'unknown'),
+        'site': device.get('site', 'default'),
+        'outcome': "failed",
+        'sections': None,
+        'phases': {},
+        'total': 0.0
+    }
+    with timings_lock:
+        run_records[device['host']] = record
+    journal_device(record, reason)
+
+def merge_record(host, phases, **fields):
+    """Add work done for a device after its worker returned (pipeline stages)."""
+    with timings_lock:
+        record = run_records.get(host)
+        if record is None:
+            return None
+        record.update(fields)
+        for phase, value in phases.items():
+            record['phases'][phase] = round(record['phases'].get(phase, 0.0) + value, 3)
+        record['total'] = round(record['total'] + sum(phases.values()), 3)
+        return dict(record)
+
+def take_records():
+    """Hand over the records gathered so far and start a fresh set."""
+    with timings_lock:
+        records = list(run_records.values())
+        run_records.clear()
+    return records
+
+@track_device_time
+def process_device(device, pool=None):
+    """
+    Back up one device. Returns True when its config was collected.
+    With a SessionPool the warm session is reused and left open.
+    """
+    if pool:
+        hostname, running_config = pool.read_config(device)
+        ssh = None
+    else:
+        hostname, running_config, ssh = get_device_config(device)
+
+    session.hostname = hostname
+    try:
+        return settle_config(device, hostname, running_config)
+    finally:
+        if ssh:
+            disconnect_device(ssh)
+
+def settle_config(device, hostname, running_config):
+    """
+    Store a collected config (or the probe's PROBE_UNCHANGED) for this
+    thread's current device. Returns False when nothing was collected.
+    """
+    if running_config == PROBE_UNCHANGED:
+        touch_hash(hostname)
+        session.outcome = "unchanged"
+        logger.info("No changes detected (probe) for %s", hostname)
+    elif hostname and running_config:
+        # a file transfer already hashed the config on the way in
+        digest = session.digest
+        if not digest:
+            with timed("normalize"):
+                digest = config_hash(running_config, device['device_type'])
+        if update_and_commit(hostname, running_config, digest, device['device_type']):
+            record_probe(hostname, device, running_config)
     else:
         logger.info(f"Skipping {device['host']} because connection/config failed")
+        return False
+    return True
     
-def main(inventory_path):
-    # Create the directories if they do not exist
-    os.makedirs(CONFIG_DIR, exist_ok=True)
-    os.makedirs(TEMP_DIR, exist_ok=True)
+@track_device_time
+def collect_device(device):
+    """
+    I/O stage of the pipeline: fetch the config and hang up straight away.
+    Returns (hostname, running_config) or (None, None) on failure or when
+    the change probe shows nothing new.
+    """
+    hostname, running_config, ssh = get_device_config(device)
+    session.hostname = hostname
+    if ssh:
+        disconnect_device(ssh)
+    if running_config == PROBE_UNCHANGED:
+        touch_hash(hostname)
+        session.outcome = "unchanged"
+        logger.info("No changes detected (probe) for %s", hostname)
+        return (None, None)
+    if hostname and running_config:
+        # the commit stage settles the outcome
+        session.outcome = "collected"
+        return (hostname, running_config)
+    logger.info(f"Skipping {device['host']} because connection/config failed")
+    return (None, None)
+
+def pipeline_diff(hostname, running_config, known_hash=None, device_type=None):
+    """
+    CPU stage of the pipeline, runs in a worker process.
+    Returns (digest, diff, sections, phases) where diff is None when there
+    is no stored config yet, '' when unchanged, otherwise the diff text,
+    sections lists the changed config blocks, and phases holds the
+    normalize/diff timings measured in the worker.
+    """
+    config_file = f"{CONFIG_DIR}/{hostname}.cfg"
+    session.phases = {}
+    with timed("normalize"):
+        digest = config_hash(running_config, device_type)
+    if digest == known_hash:
+        return (digest, '', None, session.phases)
+    diff_output = None
+    if os.path.exists(config_file):
+        with timed("diff"):
+            diff_output = compare_running_config(config_file, running_config, device_type)
+    with timed("sections"):
+        sections = section_changes(hostname, running_config, device_type, known_hash, digest)
+    return (digest, diff_output, sections, session.phases)
+
+@safe_run()
+def commit_result(hostname, running_config, device, diff_future):
+    """
+    Commit stage of the pipeline: only this thread writes configs/ and runs git.
+    """
+    session.phases, session.outcome, session.sections = {}, "failed", None
+    session.error = session.committed = None
+    try:
+        digest, diff_output, sections, diff_phases = diff_future.result()
+        # normalize/diff ran in a worker process; fold its timings in
+        session.phases.update(diff_phases)
+        if keep_snapshots:
+            save_snapshot(hostname, running_config, digest, device['device_type'])
+        store_config(hostname, running_config, diff_output, digest, sections)
+        record_probe(hostname, device, running_config)
+    finally:
+        record = merge_record(device['host'], session.phases,
+                              outcome=session.outcome, sections=session.sections)
+        if record:
+            journal_device(record)
+
+class SessionPool:
+    """
+    Warm SSH sessions kept open between polls, one per device address.
+    Sessions use transport keepalives, are swept when they die and are
+    reopened transparently when a command fails on a stale one.
+    """
+
+    def __init__(self, keepalive=KEEPALIVE_SECONDS):
+        self.keepalive = keepalive
+        self.sessions = {}
+        self.busy = set()  # hosts with a command in flight; the sweep leaves them alone
+        self.lock = Lock()
+
+    @safe_run()
+    def connect(self, device, slow=False):
+        return open_session(device, slow=slow or not fast_sessions, keepalive=self.keepalive)
+
+    def read_config(self, device):
+        """Return (hostname, running_config), reconnecting once on failure."""
+        host = device['host']
+        with self.lock:
+            self.busy.add(host)
+        try:
+            slow = False
+            for attempt in (1, 2):
+                with self.lock:
+                    ssh = self.sessions.get(host)
+                if ssh is None:
+                    ssh = self.connect(device, slow)
+                    if ssh is None:
+                        return (None, None)
+                    with self.lock:
+                        self.sessions[host] = ssh
+                else:
+                    session.connect_time = 0.0  # reused, no handshake paid
+
+                try:
+                    return read_config(ssh, device)
+                except Exception as e:
+                    # a fast session that timed out comes back on the delay-factor path
+                    slow = isinstance(e, (ReadTimeout, TruncatedConfig))
+                    logger.warning("Session to %s failed (attempt %d), reconnecting%s", host, attempt,
+                                   " with delay factor 2" if slow else "")
+                    self.discard(host)
+            return (None, None)
+        finally:
+            with self.lock:
+                self.busy.discard(host)
+
+    def discard(self, host):
+        with self.lock:
+            ssh = self.sessions.pop(host, None)
+        if ssh:
+            disconnect_device(ssh)
+
+    def sweep(self):
+        """
+        Drop sessions whose transport has died so the next poll reconnects.
+        Each idle session is taken out of the pool while it is checked, so
+        a poll starting meanwhile opens its own instead of sharing it.
+        """
+        with self.lock:
+            hosts = [host for host in self.sessions if host not in self.busy]
+        for host in hosts:
+            with self.lock:
+                if host in self.busy:
+                    continue
+                ssh = self.sessions.pop(host, None)
+            if ssh is None:
+                continue
+            alive = ssh.is_alive()
+            with self.lock:
+                if alive and host not in self.sessions:
+                    self.sessions[host] = ssh
+                    continue
+            if not alive:
+                logger.info("Session to %s is no longer alive, dropping it", host)
+            disconnect_device(ssh)
+
+    def close(self):
+        with self.lock:
+            hosts = list(self.sessions)
+        for host in hosts:
+            self.discard(host)
+
+def next_poll(device, default_interval, jitter):
+    interval = device.get('interval', default_interval)
+    return time.monotonic() + interval * random.uniform(1 - jitter, 1 + jitter)
+
+def flush_state():
+    """Persist what a one-shot run would save at the end."""
+    global pending_commits
+    if pending_commits:
+        changes, pending_commits = pending_commits, []
+        commit_batch(changes)
+    save_hash_index()
+    save_timings()
+    refresh_config_index()
+    if compliance_rules:
+        check_compliance(compliance_rules)
+    records = take_records()
+    if metrics_file and (records or committed_changes):
+        export_metrics(records)
+
+@safe_run()
+def refresh_config_index():
+    """Reindex the stored configs that changed, for `config_index.py query`."""
+    reindexed, dropped = config_index.update(CONFIG_DIR)
+    if reindexed or dropped:
+        logger.debug("Config index: %d configs reindexed, %d dropped", reindexed, dropped)
+
+@safe_run()
+def check_compliance(rules_file):
+    """Check the stored configs against a rule pack; cached results are reused."""
+    results, evaluated = compliance.evaluate(rules_file, CONFIG_DIR, HASH_INDEX_FILE)
+    totals = compliance.summary(results)
+    for hostname, violations in results.items():
+        for violation in violations:
+            logger.debug("Compliance %s: [%s] %s: %s", hostname, violation['severity'],
+                         violation['rule'], violation['message'])
+    log = logger.warning if totals['violations'] else logger.info
+    log("Compliance: %d violations on %d of %d devices (%d configs evaluated)",
+        totals['violations'], totals['failing'], totals['devices'], evaluated)
+    return totals
+
+@safe_run()
+def export_metrics(records, duration=None):
+    with timings_lock:
+        committed = committed_changes[:]
+        committed_changes.clear()
+    metrics.write_prometheus(records, metrics_file, duration, committed)
+
+@safe_run()
+def write_run_report(report_dir, **run_info):
+    """JSON timing report for the devices processed in this run."""
+    records = take_records()
+    path = metrics.write_report(metrics.build_report(records, **run_info), report_dir)
+    logger.info("Run report saved to %s", path)
+    if metrics_file:
+        export_metrics(records, run_info.get('duration'))
+
+def run_daemon(devices, concurrency=DEFAULT_CONCURRENCY,
+               interval=DEFAULT_INTERVAL, jitter=0.1, syslog=None, debounce=5.0):
+    """
+    Poll every device forever on its own interval (plus jitter), reusing
+    warm sessions from a SessionPool. Stops cleanly on Ctrl+C / SIGTERM.
+    With syslog=(bind, port), config-change messages trigger an immediate
+    backup of the sending device; interval <= 0 disables timed polling.
+    """
+    pool = SessionPool()
+    events = queue.Queue()  # ("done", i) from workers, ("trigger", i) from syslog
+    in_flight, again = set(), set()
+    # a device's scheduled entry is stale once its generation moves on
+    generation = [0] * len(devices)
+    due = []
+    if interval > 0:
+        # first polls are spread over one jitter window
+        due = [
+            (time.monotonic() + random.uniform(0, jitter * device.get('interval', interval)), i, 0)
+            for i, device in enumerate(devices)
+        ]
+        heapq.heapify(due)
+    next_sweep = next_save = time.monotonic()
+    logger.info("Daemon polling %d devices (interval %ss, jitter %d%%)",
+                len(devices), interval, jitter * 100)
+
+    def poll(i):
+        try:
+            process_device(devices[i], pool)
+        finally:
+            events.put(("done", i))
+
+    def start(executor, i):
+        generation[i] += 1
+        in_flight.add(i)
+        executor.submit(poll, i)
+
+    if syslog:
+        index_by_host = {device['host']: i for i, device in enumerate(devices)}
+
+        def lookup(source_ip, syslog_host):
+            if source_ip not in index_by_host and syslog_host:
+                # fall back to the hostname we saw in the device's own config
+                with hash_lock:
+                    source_ip = config_hashes.get(syslog_host, {}).get('host', source_ip)
+            i = index_by_host.get(source_ip)
+            return devices[i] if i is not None else None
+
+        bind, port = syslog
+        syslog_listener.start_in_thread(
+            bind, port, lookup,
+            lambda device: events.put(("trigger", index_by_host[device['host']])),
+            debounce
+        )
+
+    # only ever set by the handler: raising from it could cut a batch
+    # commit or a git command short wherever the main thread happens to be
+    stopping = Event()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    previous = {signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while not stopping.is_set():
+                now = time.monotonic()
+                while due and due[0][0] <= now:
+                    _, i, gen = heapq.heappop(due)
+                    if gen == generation[i] and i not in in_flight:
+                        start(executor, i)
+
+                if now >= next_sweep:
+                    executor.submit(pool.sweep)
+                    next_sweep = now + KEEPALIVE_SECONDS
+                if now >= next_save:
+                    flush_state()
+                    next_save = now + STATE_SAVE_SECONDS
+
+                wake_at = min([next_sweep, next_save] + ([due[0][0]] if due else []))
+                try:
+                    kind, i = events.get(timeout=max(0.0, min(wake_at - time.monotonic(), STOP_CHECK_SECONDS)))
+                except queue.Empty:
+                    continue
+
+                if kind == "trigger":
+                    # already being polled: go again once it finishes
+                    if i in in_flight:
+                        again.add(i)
+                    else:
+                        start(executor, i)
+                    continue
 
+                in_flight.discard(i)
+                if i in again:
+                    again.discard(i)
+                    start(executor, i)
+                elif interval > 0:
+                    heapq.heappush(due, (next_poll(devices[i], interval, jitter), i, generation[i]))
+            logger.info("Daemon stopping")
+    finally:
+        # save commits and indexes first; closing sessions can be slow
+        flush_state()
+        pool.close()
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+def load_inventory(inventory_path):
     with open(inventory_path, 'r') as file:
         # Convert YAML to Python dictionary
         data = yaml.safe_load(file)
-    
+
+    # hq1_hosts.yaml -> site "hq1" unless the device names its own site
+    site = os.path.splitext(os.path.basename(inventory_path))[0].replace("_hosts", "")
     devices = data['devices']
+    for device in devices:
+        device.setdefault('site', site)
+    return devices
+
+@safe_run()
+def load_timings():
+    if os.path.exists(TIMINGS_FILE):
+        with open(TIMINGS_FILE, 'r') as f:
+            device_timings.update(json.load(f))
+
+@safe_run()
+def save_timings():
+    with timings_lock:
+        with atomic_file.atomic_open(TIMINGS_FILE) as f:
+            json.dump(device_timings, f, indent=2, sort_keys=True)
 
+def expected_durations(devices):
+    """
+    Expected seconds per device: its own last total, else the average of
+    its vendor, else the average over every device we have timings for.
+    """
+    with timings_lock:
+        history = {host: entry['total'] for host, entry in device_timings.items()}
+        vendors = {}
+        for entry in device_timings.values():
+            vendors.setdefault(entry['device_type'], []).append(entry['total'])
+    vendor_avg = {vendor: sum(t) / len(t) for vendor, t in vendors.items()}
+    overall = sum(history.values()) / len(history) if history else 0.0
+
+    return [
+        history.get(d['host'], vendor_avg.get(d.get('device_type'), overall))
+        for d in devices
+    ]
+
+def lpt_order(devices):
+    """Longest-processing-time-first order; returns (devices, durations)."""
+    durations = expected_durations(devices)
+    ranked = sorted(zip(devices, durations), key=lambda pair: pair[1], reverse=True)
+    return [d for d, _ in ranked], [t for _, t in ranked]
+
+def predict_makespan(durations, workers):
+    """Wall-clock of list-scheduling `durations` (in order) on `workers` slots."""
+    if not durations:
+        return 0.0
+    slots = [0.0] * max(1, min(workers, len(durations)))
+    for duration in durations:
+        heapq.heapreplace(slots, slots[0] + duration)
+    return max(slots)
+
+def device_segment(device):
+    return (device.get('device_type', 'unknown'), device.get('site', 'default'))
+
+def run_adaptive(worker, devices, controller):
+    """
+    Let the concurrency controller pace the run; connect latency comes
+    back from get_device_config through the per-thread session.
+    """
+    def observed(device):
+        session.connect_time = None
+        ok = worker(device)
+        return (bool(ok), session.connect_time)
+
+    with tqdm(total=len(devices), desc="Processing devices", unit="device") as bar:
+        controller.run(devices, observed, device_segment, on_done=lambda: bar.update(1))
+    logger.info("Final concurrency limits: %s", controller.summary())
+
+def run_threads_with(worker, devices, concurrency=DEFAULT_CONCURRENCY, controller=None):
     """
     Run devices in parallel
     Use tqdm to show progress bar
     """
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    if controller:
+        run_adaptive(worker, devices, controller)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
         # executor.map returns an iterator of results
         list(
             tqdm(
-                executor.map(process_device, devices),
+                executor.map(worker, devices),
                 total=len(devices),
                 desc="Processing devices",
-                unit="device"
+                unit="device",
+                # in a --processes worker the parent draws the only bar
+                disable=worker_events is not None
             )
         )
 
-if __name__ == "__main__":
-    # Setup logger
-    os.makedirs(LOGS_DIR, exist_ok=True)
-    logger = setup_logger()
+def run_threads(devices, concurrency=DEFAULT_CONCURRENCY, controller=None):
+    run_threads_with(process_device, devices, concurrency, controller)
+
+def run_pipeline(devices, concurrency=DEFAULT_CONCURRENCY,
+                 diff_workers=None, queue_depth=DEFAULT_QUEUE_DEPTH, controller=None):
+    """
+    Staged run: SSH threads only collect, a process pool normalizes and diffs,
+    and a single committer thread writes configs/ and talks to git.
+    Bounded queues between the stages cap how many configs sit in memory,
+    and a slow diff or commit never holds an SSH slot.
+    """
+    collected = queue.Queue(maxsize=queue_depth)
+    diffed = queue.Queue(maxsize=queue_depth)
+
+    def dispatcher(pool):
+        while True:
+            item = collected.get()
+            if item is PIPELINE_STOP:
+                diffed.put(PIPELINE_STOP)
+                return
+            hostname, running_config, device = item
+            known_hash = indexed_hash(hostname, f"{CONFIG_DIR}/{hostname}.cfg")
+            future = pool.submit(
+                pipeline_diff, hostname, running_config, known_hash, device['device_type']
+            )
+            diffed.put((hostname, running_config, device, future))
+
+    def committer():
+        while True:
+            item = diffed.get()
+            if item is PIPELINE_STOP:
+                return
+            commit_result(*item)
+
+    def collect(device):
+        hostname, running_config = collect_device(device)
+        if hostname:
+            # blocks when the diff stage falls behind
+            collected.put((hostname, running_config, device))
+        return hostname is not None or session.connect_time is not None
+
+    with spawn_pool(diff_workers) as pool:
+        stages = [Thread(target=dispatcher, args=(pool,)), Thread(target=committer)]
+        for stage in stages:
+            stage.start()
+
+        run_threads_with(collect, devices, concurrency, controller)
+
+        collected.put(PIPELINE_STOP)
+        for stage in stages:
+            stage.join()
+
+def clean_terminal(text):
+    """Shell output as netmiko hands it back: LF line endings, no ANSI codes."""
+    return ANSI_ESCAPE.sub("", LINE_ENDINGS.sub("\n", text))
+
+class AsyncSession:
+    """
+    CLI session of the asyncio engine: a pty shell on asyncssh, read until
+    the prompt is back. Output comes back the way netmiko returns it (echo
+    and trailing prompt dropped, see clean_terminal), so a config hashes
+    the same whichever engine collected it.
+    """
+
+    def __init__(self, conn, process, device):
+        self.conn = conn
+        self.process = process
+        self.device = device
+        self.prompt = None    # last prompt line, as find_prompt() returns it
+        self.pattern = None   # prompt_pattern() of this session
+
+    @classmethod
+    async def open(cls, device, phases):
+        """
+        Connect, log in and prepare the terminal; connect/auth time goes to
+        `phases`.
+        """
+        commands = COMMANDS.get(device['device_type'], {})
+        timeout = device.get('conn_timeout', 10)
+        options = {
+            'port': device.get('port', 22),
+            'username': device['username'] + commands.get('login_suffix', ''),
+            'password': device.get('password'),
+            'known_hosts': None,
+            # netmiko's budget: conn_timeout for TCP, then banner_timeout
+            # for the device to start the SSH handshake
+            'connect_timeout': timeout + device.get('banner_timeout', 15),
+        }
+        if device.get('ssh_config_file'):
+            options['config'] = [device['ssh_config_file']]
+        sock = None
+        try:
+            with timed("tcp_connect", phases):
+                sock = device.get('sock') or await open_socket_async(device)
+            if sock:
+                options['sock'] = sock
+            with timed("ssh_auth", phases):
+                conn = await asyncssh.connect(device['host'], **options)
+        except asyncio.TimeoutError:
+            if sock:
+                sock.close()
+            raise TimeoutError(f"Connecting to {device['host']} timed out") from None
+        except BaseException:
+            if sock:
+                sock.close()
+            raise
+        logger.info("Connected to %s", device['host'])
+        try:
+            process = await conn.create_process(term_type='vt100', term_size=(511, 1000),
+                                                encoding='utf-8', errors='replace')
+            ssh = cls(conn, process, device)
+            await ssh.prepare(commands, timeout)
+        except BaseException:
+            conn.close()
+            raise
+        return ssh
+
+    async def prepare(self, commands, timeout):
+        """Find the base prompt, turn paging off and enable on Cisco."""
+        terminator = commands.get('prompt', r'[>#]')
+        banner = await self.read_until(rf"{terminator}\s*$", timeout)
+        self.prompt = banner.rstrip().split("\n")[-1].strip()
+        base_prompt = re.sub(rf"{terminator}\s*$", "", self.prompt)
+        self.pattern = prompt_pattern(base_prompt, self.device['device_type'])
+        for command in commands.get('session', []):
+            await self.send_command(command, timeout)
 
+        # Cisco needs enable
+        if self.device['device_type'] == 'cisco_ios' and not self.prompt.endswith("#"):
+            self.process.stdin.write("enable\n")
+            output = await self.read_until(rf"(?i)password:\s*$|{self.pattern}", timeout)
+            if not re.search(self.pattern, output):
+                self.process.stdin.write(f"{self.device.get('secret', '')}\n")
+                await self.read_until(self.pattern, timeout)
+
+    async def read_until(self, pattern, timeout):
+        """Read the shell until `pattern` matches the end of the output."""
+        chunks, tail = [], ""
+
+        async def read():
+            nonlocal tail
+            while True:
+                chunk = await self.process.stdout.read(ASYNC_READ_SIZE)
+                if not chunk:
+                    raise EOFError(f"{self.device['host']} closed the session")
+                chunks.append(chunk)
+                tail = (tail + chunk)[-1024:]
+                if re.search(pattern, clean_terminal(tail)):
+                    return
+
+        try:
+            await asyncio.wait_for(read(), timeout)
+        except asyncio.TimeoutError:
+            raise ReadTimeout(f"Pattern not detected: {pattern!r} in output after {timeout}s") from None
+        return clean_terminal("".join(chunks))
+
+    async def send_command(self, command, read_timeout=10.0):
+        """Run a command and return its output without the echo and the prompt."""
+        self.process.stdin.write(f"{command}\n")
+        lines = (await self.read_until(self.pattern, read_timeout)).split("\n")
+        if lines[0].strip().endswith(command.strip()):
+            lines = lines[1:]
+        self.prompt = lines.pop().strip() if lines else self.prompt
+        return "\n".join(lines)
+
+    def close(self):
+        self.conn.close()
+
+async def open_socket_async(device):
+    """open_socket() for the event loop: a non-blocking TCP connection, or None."""
+    if any(device.get(key) for key in PROXY_KEYS):
+        return None
+    loop = asyncio.get_running_loop()
+    family, kind, proto, _, address = (await loop.getaddrinfo(
+        device['host'], device.get('port', 22), type=socket.SOCK_STREAM
+    ))[0]
+    sock = socket.socket(family, kind, proto)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, address), device.get('conn_timeout', 10))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+async def read_config_async(ssh, device, phases, slow=False):
+    """
+    read_config() on an AsyncSession: the change probe, the running config
+    and, when the config doesn't carry it, the hostname.
+    """
+    device_type = device.get('device_type', 'unknown')
+    commands = COMMANDS.get(device_type, {})
+
+    if probe_changes and commands.get('probe'):
+        known = known_probe(device['host'])
+        if known:
+            with timed("probe", phases):
+                marker = change_marker(device_type, await ssh.send_command(commands['probe']))
+            if marker == known[1]:
+                return (known[0], PROBE_UNCHANGED)
+
+    with timed("fetch", phases):
+        running_config = await ssh.send_command(
+            commands.get('running_config'), SLOW_READ_TIMEOUT if slow else fetch_timeout(device)
+        )
+    end_marker = commands.get('end_marker')
+    if not slow and end_marker and not re.search(end_marker, running_config[-4096:], re.MULTILINE):
+        raise TruncatedConfig(f"no {end_marker!r} line at the end of the config")
+
+    hostname = parse_hostname(device_type, running_config)
+    if not hostname:
+        with timed("hostname", phases):
+            if device_type == 'mikrotik_routeros':
+                hostname = hostname_from_prompt(device, ssh.prompt)
+            else:
+                hostname = hostname_from_output(device, await ssh.send_command(commands.get('hostname')))
+    return (hostname, running_config)
+
+async def fetch_config_async(device, phases, slow=False):
+    ssh = await AsyncSession.open(device, phases)
+    try:
+        return await read_config_async(ssh, device, phases, slow)
+    finally:
+        ssh.close()
+
+async def collect_async(device, semaphore):
+    """
+    Collect one device once a `semaphore` slot is free. A fast read that
+    times out (or truncates the config) is retried once with the long
+    timeout. Returns (hostname, running_config, phases, seconds, error).
+    """
+    phases, error = {}, None
+    async with semaphore:
+        start = time.monotonic()
+        try:
+            try:
+                hostname, running_config = await fetch_config_async(
+                    device, phases, slow=not fast_sessions
+                )
+            except (ReadTimeout, TruncatedConfig) as e:
+                if not fast_sessions:
+                    raise
+                reason = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+                logger.warning("Fast session to %s failed (%s), retrying with the long timeout",
+                               device['host'], reason)
+                hostname, running_config = await fetch_config_async(device, phases, slow=True)
+        except Exception as e:
+            logger.exception("[%s] error", "collect_async")
+            hostname = running_config = None
+            error = f"{type(e).__name__}: {e}"
+        return (hostname, running_config, phases, time.monotonic() - start, error)
+
+def settle_collected(device, hostname, running_config, phases, seconds, error):
+    """Thread side of the asyncio engine: store a collected config like process_device()."""
+    start_device()
+    session.phases.update(phases)
+    session.hostname, session.error = hostname, error
+    start = time.monotonic()
+    try:
+        return settle_config(device, hostname, running_config)
+    finally:
+        finish_device(device, seconds + time.monotonic() - start)
+
+async def collect_all(devices, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=SETTLE_WORKERS) as settlers, \
+            tqdm(total=len(devices), desc="Processing devices", unit="device") as bar:
+        async def run(device):
+            collected = await collect_async(device, semaphore)
+            # diffing and git block, so they run off the event loop
+            await loop.run_in_executor(settlers, settle_collected, device, *collected)
+            bar.update(1)
+
+        await asyncio.gather(*(run(device) for device in devices))
+
+def run_asyncio(devices, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Event-loop run: up to `concurrency` asyncssh sessions in flight on one
+    thread, each config handed to SETTLE_WORKERS threads that diff and
+    commit it through settle_config(), like the threads engine.
+    """
+    asyncio.run(collect_all(devices, concurrency))
+
+def split_devices(devices, parts):
+    """
+    Deal devices into `parts` lists of about equal expected duration
+    (longest first, each to the least loaded list).
+    """
+    ranked, durations = lpt_order(devices)
+    loads = [(0.0, i) for i in range(max(1, min(parts, len(devices))))]
+    shares = [[] for _ in loads]
+    for device, duration in zip(ranked, durations):
+        load, i = heapq.heappop(loads)
+        shares[i].append(device)
+        heapq.heappush(loads, (load + duration, i))
+    return shares
+
+def process_worker(index, devices, concurrency, args, log_level, events, log_queue,
+                   initializer=None, initargs=()):
+    """
+    Body of one --processes worker: back up `devices` with the thread
+    pool, sending device outcomes and commit requests to the parent as
+    they happen, and the updated hash/timing entries when done.
+    :param args: the parent's parsed command line (None: module defaults)
+    """
+    global worker_events
+    logger.handlers[:] = [QueueHandler(log_queue)]
+    logger.setLevel(log_level)
+    worker_events = events
+    try:
+        if args is not None:
+            apply_options(args)
+        load_hash_index()
+        load_timings()
+        if initializer:
+            initializer(*initargs)
+        run_threads(devices, concurrency)
+    except Exception:
+        logger.exception("Worker process %d failed", index)
+    finally:
+        hostnames = {record['hostname'] for record in take_records() if record['hostname']}
+        with hash_lock:
+            hashes = {hostname: config_hashes[hostname] for hostname in hostnames if hostname in config_hashes}
+        with timings_lock:
+            timings = {d['host']: device_timings[d['host']] for d in devices if d['host'] in device_timings}
+        events.put(("done", index, hashes, timings))
+
+def run_processes(devices, processes, concurrency=DEFAULT_CONCURRENCY,
+                  initializer=None, initargs=()):
+    """
+    Back up devices in `processes` worker processes, so SSH crypto and
+    config normalization are not all serialized behind one GIL. Workers
+    send back device outcomes and commit requests; this process journals
+    the devices, runs git and merges the hash index and timings.
+    :param initializer: called with `initargs` in every worker before it starts
+    """
+    shares = split_devices(devices, processes)
+    events, log_queue = SPAWN.Queue(), SPAWN.Queue()
+    listener = QueueListener(log_queue, ForwardHandler())
+    listener.start()
+    log_level = min((handler.level for handler in logger.handlers), default=logger.getEffectiveLevel())
+    workers = [
+        SPAWN.Process(
+            target=process_worker, name=f"guardian-worker-{i}",
+            args=(i, share, concurrency, options, log_level, events, log_queue, initializer, initargs)
+        )
+        for i, share in enumerate(shares)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info("Started %d worker processes (%s)", len(workers), ", ".join(str(len(share)) for share in shares))
+
+    pending = set(range(len(workers)))
+    committed = {}  # hostname -> (commit result, commit phases) until its device outcome arrives
+    try:
+        with tqdm(total=len(devices), desc="Processing devices", unit="device") as bar:
+            while pending:
+                try:
+                    event = events.get(timeout=1)
+                except queue.Empty:
+                    dead = [i for i in pending if not workers[i].is_alive()]
+                    try:
+                        # whatever a dead worker sent last is still in the queue
+                        event = events.get(timeout=1) if dead else None
+                    except queue.Empty:
+                        event = None
+                        for i in dead:
+                            logger.error("Worker process %d exited with code %s", i, workers[i].exitcode)
+                            pending.discard(i)
+                    if event is None:
+                        continue
+
+                if event[0] == "commit":
+                    _, filename, hostname, detect_time = event
+                    session.phases = {}
+                    committed[hostname] = (commit_changes(filename, hostname, detect_time), session.phases)
+                elif event[0] == "device":
+                    _, record, reason = event
+                    result, phases = committed.pop(record['hostname'], (None, {}))
+                    for phase, seconds in phases.items():
+                        record['phases'][phase] = round(seconds, 3)
+                        record['total'] = round(record['total'] + seconds, 3)
+                    with timings_lock:
+                        run_records[record['host']] = record
+                    session.committed = result
+                    journal_device(record, reason)
+                    bar.update(1)
+                elif event[0] == "done":
+                    _, i, hashes, timings = event
+                    with hash_lock:
+                        config_hashes.update(hashes)
+                        for hostname, entry in hashes.items():
+                            if entry.get('host'):
+                                hostnames_by_host[entry['host']] = hostname
+                    with timings_lock:
+                        device_timings.update(timings)
+                    pending.discard(i)
+    finally:
+        for worker in workers:
+            worker.join()
+        listener.stop()
+
+def catch_up_devices(devices, retry_failed=False):
+    """
+    Devices a --resume (never reached or failed) or --retry-failed (failed
+    only) run still has to do, going by the journal of the last run.
+    Returns (devices, run ID, journal entries); run ID is None without a journal.
+    """
+    previous = run_journal.last_run()
+    if previous is None:
+        logger.warning("No run journal found, processing every device")
+        return devices, None, {}
+    run, hosts, entries, finished = previous
+
+    if retry_failed:
+        wanted = {host for host, entry in entries.items() if entry['outcome'] == "failed"}
+    else:
+        wanted = {host for host in hosts if entries.get(host, {}).get('outcome', "failed") == "failed"}
+    selected = [device for device in devices if device['host'] in wanted]
+    logger.info(
+        "%s run %s (%s): %d of %d devices left",
+        "Retrying failures of" if retry_failed else "Resuming", run,
+        "finished" if finished else "interrupted", len(selected), len(hosts)
+    )
+    return selected, run, entries
+
+@safe_run()
+def commit_leftovers(entries):
+    """
+    Commit configs an interrupted batch run wrote but never committed;
+    reprocessing those devices would find nothing left to commit.
+    """
+    files = {
+        f"{CONFIG_DIR}/{entry['hostname']}.cfg": entry['hostname']
+        for entry in entries.values()
+        if entry['outcome'] == "changed" and not entry.get('committed')
+    }
+    files = {filename: hostname for filename, hostname in files.items() if os.path.exists(filename)}
+    if not files:
+        return
+    dirty = git("diff", "--name-only", "--relative", "HEAD", "--", *files).splitlines()
+    timestamp = datetime.now().strftime(DATE_FORMAT)
+    if dirty and commit_batch([(filename, files[filename], timestamp) for filename in dirty]):
+        journal.committed(files[filename] for filename in dirty)
+
+def merge_shards(shard_dirs, report_dir=REPORTS_DIR):
+    """
+    Bring the results of sharded runs into this repository: the newest
+    config of every device is copied from the shard directories and all
+    changed configs go into one commit; the shards' latest run reports are
+    combined into one report.
+    """
+    timestamp = datetime.now().strftime(DATE_FORMAT)
+    changes = []
+    for hostname, (shard_dir, entry) in sharding.newest_entries(shard_dirs, HASH_INDEX_FILE).items():
+        source = os.path.join(shard_dir, CONFIG_DIR, f"{hostname}.cfg")
+        if not os.path.exists(source):
+            continue
+        config_file = f"{CONFIG_DIR}/{hostname}.cfg"
+        if not os.path.exists(config_file) or not filecmp.cmp(source, config_file, shallow=False):
+            shutil.copyfile(source, config_file)
+            changes.append((config_file, hostname, entry.get('last_seen', timestamp)))
+        with hash_lock:
+            config_hashes[hostname] = dict(entry, size=os.path.getsize(config_file))
+            if entry.get('host'):
+                hostnames_by_host[entry['host']] = hostname
+    logger.info("Merging %d changed configs from %d shards", len(changes), len(shard_dirs))
+    commit_batch(changes)
+    save_hash_index()
+    refresh_config_index()
+
+    reports = [report for report in (sharding.latest_report(shard_dir, REPORTS_DIR) for shard_dir in shard_dirs)
+               if report]
+    path = metrics.write_report(metrics.build_report(
+        sharding.merge_records(reports), started=timestamp,
+        shards={report.get('shard', report['path']): report['path'] for report in reports},
+        duration=max((report.get('duration') or 0 for report in reports), default=0),
+    ), report_dir)
+    logger.info("Merged run report of %d shards saved to %s", len(reports), path)
+
+def main(args):
+    global pending_commits, journal
+
+    # Create the directories if they do not exist
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    apply_options(args)
+
+    devices = [d for path in args.inventory for d in load_inventory(path)]
+    load_hash_index()
+    load_timings()
+
+    if args.merge_shards:
+        merge_shards(args.merge_shards, args.report_dir)
+        return
+    if args.shard_nodes:
+        nodes = args.shard_nodes[1]
+        total = len(devices)
+        devices = sharding.shard_devices(devices, shard_node, nodes)
+        logger.info("Shard %s of %s: %d of %d devices", shard_node, ",".join(nodes), len(devices), total)
+
+    if args.batch_commit:
+        pending_commits = []
+
+    if args.daemon:
+        syslog = (args.syslog_bind, args.syslog_port) if args.syslog_port else None
+        run_daemon(devices, args.concurrency, args.interval, args.jitter, syslog, args.debounce)
+        return
+
+    run, entries = None, {}
+    if args.resume or args.retry_failed:
+        devices, run, entries = catch_up_devices(devices, args.retry_failed)
+
+    journal = run_journal.RunJournal()
+    mode = "retry-failed" if args.retry_failed else "resume" if args.resume else "full"
+    journal.start([d['host'] for d in devices], mode, run)
+    if shard_node is None:
+        commit_leftovers(entries)
+
+    if args.precheck:
+        breaker = reachability.CircuitBreaker(args.breaker_cooldown)
+        devices, skipped = reachability.precheck(
+            devices, breaker, args.precheck_timeout, args.precheck_retries
+        )
+        for device, reason in skipped:
+            skip_device(device, reason)
+
+    if args.schedule == "lpt":
+        devices, durations = lpt_order(devices)
+    else:
+        durations = expected_durations(devices)
+    workers = args.concurrency * (args.processes or 1)
+    predicted = predict_makespan(durations, workers)
+    started = datetime.now().strftime(DATE_FORMAT)
+    start = time.monotonic()
+
+    controller = None
+    if args.adaptive:
+        controller = ConcurrencyController(args.vendor_limit, args.site_limit, args.concurrency)
+
+    if args.processes:
+        run_processes(devices, args.processes, args.concurrency)
+    elif args.engine == "pipeline":
+        run_pipeline(devices, args.concurrency, args.diff_workers, args.queue_depth, controller)
+    elif args.engine == "asyncio":
+        run_asyncio(devices, args.concurrency)
+    else:
+        run_threads(devices, args.concurrency, controller)
+
+    if args.batch_commit:
+        if commit_batch(pending_commits):
+            journal.committed(hostname for _, hostname, _ in pending_commits)
+        pending_commits = None
+
+    actual = time.monotonic() - start
+    logger.info(
+        "Makespan: predicted %.1fs (%s order, %d workers), actual %.1fs",
+        predicted, args.schedule, workers, actual
+    )
+    save_hash_index()
+    save_timings()
+    refresh_config_index()
+    compliance_totals = check_compliance(compliance_rules) if compliance_rules else None
+    write_run_report(
+        args.report_dir, started=started, engine=args.engine, schedule=args.schedule,
+        concurrency=args.concurrency, processes=args.processes, predicted_makespan=round(predicted, 3),
+        duration=round(actual, 3), compliance=compliance_totals, shard=args.shard,
+        file_transfer=args.file_transfer
+    )
+    journal.end()
+
+if __name__ == "__main__":
     args = parse_args()
 
-    # set console level based on --verbose flag
+    # Setup logger: file still defaults to DEBUG so diffs are recorded,
+    # console level follows the --verbose flag
+    os.makedirs(LOGS_DIR, exist_ok=True)
     console_level = logging.DEBUG if args.verbose else logging.INFO
+    logger = setup_logger(console_level=console_level, log_format=args.log_format)
 
-    # create logger (file will still default to DEBUG so diffs are recorded)
-    logger = setup_logger(console_level=console_level)
-    
-    main(args.inventory)
+    main(args)
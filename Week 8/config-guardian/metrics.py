@@ -0,0 +1,182 @@
+# Run reports and Prometheus metrics for guardian.
+#
+# Every device processed in a run produces one record:
+#   {host, hostname, device_type, site, outcome, phases: {phase: seconds}, total}
+# build_report() turns the records into a JSON run report and
+# write_prometheus() into a node_exporter textfile.
+
+import json
+import os
+import re
+from datetime import datetime
+
+import atomic_file
+
+OUTCOMES = ("first_run", "changed", "unchanged", "failed")
+
+# seconds; a 60s read_timeout is the slowest thing a session normally does
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Series that only ever go up; their previous values are carried forward
+CUMULATIVE_SUFFIXES = ("_bucket", "_sum", "_count", "_total")
+SAMPLE_LINE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*(?:\{[^}]*\})?) (\S+)$")
+LE_LABEL = re.compile(r',?le="([^"]+)"')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def build_report(records, **run_info):
+    """
+    JSON-ready run report: run metadata, outcome totals, per-phase
+    summary (count/sum/p50/p95/max) and every device record.
+    """
+    totals = {outcome: 0 for outcome in OUTCOMES}
+    by_phase = {}
+    for record in records:
+        totals[record['outcome']] = totals.get(record['outcome'], 0) + 1
+        for phase, seconds in record['phases'].items():
+            by_phase.setdefault(phase, []).append(seconds)
+
+    phases = {
+        phase: {
+            'count': len(values),
+            'sum': round(sum(values), 3),
+            'p50': round(percentile(values, 0.50), 3),
+            'p95': round(percentile(values, 0.95), 3),
+            'max': round(max(values), 3),
+        }
+        for phase, values in sorted(by_phase.items())
+    }
+    slowest = sorted(records, key=lambda record: record['total'], reverse=True)
+    return {
+        **run_info,
+        'devices': len(records),
+        'totals': totals,
+        'phases': phases,
+        'slowest': [record['host'] for record in slowest[:10]],
+        'records': sorted(records, key=lambda record: record['host']),
+    }
+
+
+def write_report(report, report_dir):
+    """Write the report to <report_dir>/run_<timestamp>.json and return the path."""
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, f"run_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def labels(**pairs):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs.items()) + "}"
+
+
+def observe(samples, name, value, **label_pairs):
+    """Add one observation to a histogram held in `samples`."""
+    for bound in BUCKETS:
+        key = f"{name}_bucket{labels(**label_pairs, le=bound)}"
+        samples[key] = samples.get(key, 0) + (1 if value <= bound else 0)
+    key = f"{name}_bucket{labels(**label_pairs, le='+Inf')}"
+    samples[key] = samples.get(key, 0) + 1
+    for suffix, amount in (("_sum", value), ("_count", 1)):
+        key = f"{name}{suffix}{labels(**label_pairs)}"
+        samples[key] = samples.get(key, 0) + amount
+
+
+def read_samples(path):
+    """Parse a textfile written earlier; returns {series: value}."""
+    samples = {}
+    if not os.path.exists(path):
+        return samples
+    with open(path, 'r') as f:
+        for line in f:
+            match = SAMPLE_LINE.match(line.strip())
+            if match:
+                samples[match.group(1)] = float(match.group(2))
+    return samples
+
+
+HELP = {
+    'guardian_phase_duration_seconds': ('histogram', 'Time spent per device in each backup phase.'),
+    'guardian_device_duration_seconds': ('histogram', 'Total time spent per device.'),
+    'guardian_devices_total': ('counter', 'Devices processed, by outcome.'),
+    'guardian_device_failures_total': ('counter', 'Devices whose backup failed.'),
+    'guardian_config_changes_total': ('counter', 'Config changes detected and committed.'),
+    'guardian_last_run_duration_seconds': ('gauge', 'Wall-clock duration of the last run or flush.'),
+    'guardian_last_run_timestamp_seconds': ('gauge', 'Unix time the metrics were last written.'),
+}
+
+
+def series_order(key):
+    """Sort key: one label set at a time, buckets in numeric le order, then _sum and _count."""
+    name, _, rest = key.partition("{")
+    match = LE_LABEL.search(rest)
+    bound = 0.0
+    if match:
+        bound = float("inf") if match.group(1) == "+Inf" else float(match.group(1))
+    rank = next((i for i, suffix in enumerate(("_bucket", "_sum", "_count")) if name.endswith(suffix)), 0)
+    return (LE_LABEL.sub("", rest), rank, bound)
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else f"{value:.6f}".rstrip("0")
+
+
+def write_prometheus(records, path, duration=None, committed=()):
+    """
+    Add this run's records to the textfile at `path`. Counters and
+    histograms continue from the values already in the file, so they stay
+    monotonic across runs (and across daemon flushes); without a new
+    `duration` the last one is kept.
+    :param committed: device type of every config change committed since
+                      the last write (changes still waiting for a batch
+                      commit are left out)
+    """
+    samples = {}
+    for record in records:
+        device_type = record.get('device_type', 'unknown')
+        for phase, seconds in record['phases'].items():
+            observe(samples, 'guardian_phase_duration_seconds', seconds,
+                    phase=phase, device_type=device_type)
+        observe(samples, 'guardian_device_duration_seconds', record['total'], device_type=device_type)
+        key = f"guardian_devices_total{labels(outcome=record['outcome'])}"
+        samples[key] = samples.get(key, 0) + 1
+        if record['outcome'] == 'failed':
+            key = f"guardian_device_failures_total{labels(device_type=device_type)}"
+            samples[key] = samples.get(key, 0) + 1
+    for device_type in committed:
+        key = f"guardian_config_changes_total{labels(device_type=device_type)}"
+        samples[key] = samples.get(key, 0) + 1
+
+    previous = read_samples(path)
+    for key, value in previous.items():
+        name = key.split("{")[0]
+        if name.endswith(CUMULATIVE_SUFFIXES):
+            samples[key] = samples.get(key, 0) + value
+
+    if duration is not None:
+        samples['guardian_last_run_duration_seconds'] = round(duration, 3)
+    elif 'guardian_last_run_duration_seconds' in previous:
+        samples['guardian_last_run_duration_seconds'] = previous['guardian_last_run_duration_seconds']
+    samples['guardian_last_run_timestamp_seconds'] = round(datetime.now().timestamp(), 3)
+
+    lines = []
+    for metric, (kind, text) in HELP.items():
+        series = sorted(
+            (key for key in samples if key.split("{")[0].startswith(metric)
+             and key.split("{")[0][len(metric):] in ("", "_bucket", "_sum", "_count")),
+            key=series_order
+        )
+        if not series:
+            continue
+        lines.append(f"# HELP {metric} {text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        lines += [f"{key} {format_value(samples[key])}" for key in series]
+
+    # the textfile collector may read at any moment: write aside, then swap in
+    atomic_file.atomic_write(path, "\n".join(lines) + "\n")
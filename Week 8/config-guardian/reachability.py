@@ -0,0 +1,134 @@
+# Reachability pre-check for guardian runs.
+#
+# Before any SSH worker is scheduled, every device's SSH port is probed
+# with a plain TCP connect, all at once on one event loop. Devices that do
+# not answer are retried with exponential backoff and then skipped, so
+# worker slots are not spent waiting out netmiko connect timeouts.
+#
+# A per-device circuit breaker (device_health.json) remembers devices that
+# keep failing: after a failed pre-check a device is not even probed again
+# until its cooldown, which doubles with every consecutive failure, is over.
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+import atomic_file
+
+logger = logging.getLogger("config_guardian")
+
+HEALTH_FILE = "device_health.json"
+PROBE_CONCURRENCY = 500    # sockets open at once during the pre-check
+MAX_COOLDOWN = 24 * 3600   # the breaker never stays open longer than this
+
+
+async def probe(host, port, timeout):
+    """TCP connect to host:port; returns None when it answers, else the reason."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        return f"TCP {port} timed out after {timeout}s"
+    except OSError as e:
+        return f"TCP {port}: {e.strerror or e}"
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return None
+
+
+async def probe_with_backoff(limit, host, port, timeout, retries, backoff):
+    reason = None
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(backoff * 2 ** (attempt - 1))
+        async with limit:
+            reason = await probe(host, port, timeout)
+        if reason is None:
+            return None
+    return reason
+
+
+async def probe_all(targets, timeout=3.0, retries=2, backoff=0.5):
+    """
+    Probe every (host, port) at once. Returns {host: None if reachable,
+    else the reason of the last failed attempt}.
+    """
+    limit = asyncio.Semaphore(PROBE_CONCURRENCY)
+    reasons = await asyncio.gather(*(
+        probe_with_backoff(limit, host, port, timeout, retries, backoff)
+        for host, port in targets
+    ))
+    return {host: reason for (host, _), reason in zip(targets, reasons)}
+
+
+class CircuitBreaker:
+    """
+    Per-device failure memory: host -> {failures, open_until, reason}.
+    :param cooldown: seconds a device is skipped after its first failure
+    """
+
+    def __init__(self, cooldown=900, path=HEALTH_FILE):
+        self.cooldown = cooldown
+        self.path = path
+        self.state = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.state = json.load(f)
+
+    def is_open(self, host, now=None):
+        """True while `host` is still cooling down and should be skipped."""
+        entry = self.state.get(host)
+        return bool(entry) and (now or time.time()) < entry['open_until']
+
+    def record(self, host, reason, now=None):
+        """Close the breaker on success (reason None), otherwise open it for longer."""
+        if reason is None:
+            self.state.pop(host, None)
+            return
+        entry = self.state.setdefault(host, {'failures': 0})
+        entry['failures'] += 1
+        entry['reason'] = reason
+        entry['open_until'] = (now or time.time()) + min(
+            self.cooldown * 2 ** (entry['failures'] - 1), MAX_COOLDOWN
+        )
+
+    def save(self):
+        with atomic_file.atomic_open(self.path) as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+
+
+def precheck(devices, breaker, timeout=3.0, retries=2, backoff=0.5):
+    """
+    Split devices into (reachable, skipped) where skipped is a list of
+    (device, reason). Devices whose breaker is open are skipped unprobed.
+    """
+    skipped, candidates = [], []
+    for device in devices:
+        if breaker.is_open(device['host']):
+            entry = breaker.state[device['host']]
+            skipped.append((device, f"circuit open after {entry['failures']} failures: {entry['reason']}"))
+        else:
+            candidates.append(device)
+
+    start = time.monotonic()
+    targets = [(device['host'], device.get('port', 22)) for device in candidates]
+    reasons = asyncio.run(probe_all(targets, timeout, retries, backoff)) if targets else {}
+
+    reachable = []
+    for device in candidates:
+        reason = reasons[device['host']]
+        breaker.record(device['host'], reason)
+        if reason is None:
+            reachable.append(device)
+        else:
+            skipped.append((device, reason))
+    breaker.save()
+    logger.info(
+        "Pre-check: %d of %d devices reachable in %.1fs (%d skipped)",
+        len(reachable), len(devices), time.monotonic() - start, len(skipped)
+    )
+    return reachable, skipped
@@ -0,0 +1,99 @@
+# Append-only checkpoint journal for guardian runs.
+#
+# One JSON object per line:
+#   {"event": "start", "run": ID, "time": ..., "hosts": [...], "mode": "full|resume|retry-failed"}
+#   {"event": "device", "run": ID, "host": ..., "hostname": ..., "outcome": ..., "reason": ...}
+#   {"event": "committed", "run": ID, "hosts": [...]}      (after a batch commit)
+#   {"event": "end", "run": ID, "time": ...}
+#
+# A resumed or retried run appends to the same run ID, so replaying the
+# journal always gives the latest outcome of every device in that run.
+
+import json
+import os
+from datetime import datetime
+from threading import Lock
+
+JOURNAL_FILE = "run_journal.jsonl"
+DATE_FORMAT = "%Y%m%d-%H%M%S"
+
+
+class RunJournal:
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.run = None
+        self.lock = Lock()
+        self.file = None
+
+    def start(self, hosts, mode="full", run=None):
+        """
+        Open the journal for a run. A full run starts a new journal (the
+        previous one is kept as <path>.1); resumes append to `run`.
+        """
+        if run is None:
+            if os.path.exists(self.path):
+                os.replace(self.path, f"{self.path}.1")
+            run = datetime.now().strftime(DATE_FORMAT)
+        self.run = run
+        self.file = open(self.path, 'a')
+        self.write({'event': "start", 'time': datetime.now().strftime(DATE_FORMAT),
+                    'hosts': list(hosts), 'mode': mode})
+
+    def write(self, entry):
+        # flushed per line: a killed run loses at most the device in progress
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps({**entry, 'run': self.run}) + "\n")
+            self.file.flush()
+
+    def device(self, host, hostname, outcome, reason=None, committed=None):
+        entry = {'event': "device", 'host': host, 'hostname': hostname, 'outcome': outcome}
+        if reason:
+            entry['reason'] = reason
+        if committed is not None:
+            entry['committed'] = committed
+        self.write(entry)
+
+    def committed(self, hosts):
+        self.write({'event': "committed", 'hosts': list(hosts)})
+
+    def end(self):
+        self.write({'event': "end", 'time': datetime.now().strftime(DATE_FORMAT)})
+        with self.lock:
+            self.file.close()
+            self.file = None
+
+
+def last_run(path=JOURNAL_FILE):
+    """
+    Replay the journal. Returns (run ID, hosts in run order, {host: latest
+    device entry}, finished) for the most recent run, or None without one.
+    """
+    if not os.path.exists(path):
+        return None
+    run, hosts, devices, finished = None, [], {}, False
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # half-written last line of a killed run
+            if entry['event'] == "start" and entry['run'] != run:
+                run, hosts, devices = entry['run'], entry['hosts'], {}
+            if entry['run'] != run:
+                continue
+            if entry['event'] == "start":
+                finished = False
+            elif entry['event'] == "device":
+                devices[entry['host']] = entry
+            elif entry['event'] == "committed":
+                committed = set(entry['hosts'])
+                for device in devices.values():
+                    if device.get('hostname') in committed:
+                        device['committed'] = True
+            elif entry['event'] == "end":
+                finished = True
+    if run is None:
+        return None
+    return run, hosts, devices, finished
@@ -0,0 +1,103 @@
+# Splitting one inventory across several guardian nodes.
+#
+# Devices are assigned to nodes by consistent hashing on their address:
+# every node owns VNODES points on a hash ring and a device goes to the
+# node owning the first point after the device's hash. Adding or removing
+# a node only moves the devices between it and its ring neighbours (about
+# 1/N of them), so the other nodes keep their warm caches and history.
+#
+# Each node runs `guardian.py --shard i/N` (or `--shard NAME --shard-members
+# a,b,c`) in its own copy of the repository and leaves its changed configs
+# uncommitted. `guardian.py --merge-shards DIR...` then copies the newest
+# config of every device from the shard directories, commits them as one
+# commit and writes one combined run report. A failed node only means
+# rerunning its shard and merging again.
+
+import bisect
+import glob
+import hashlib
+import json
+import os
+
+VNODES = 128   # ring points per node; more points, more even shards
+
+
+def ring_point(key):
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent-hash ring over node names."""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+        self.nodes = list(nodes)
+        ring = sorted((ring_point(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self.points = [point for point, _ in ring]
+        self.owners = [node for _, node in ring]
+
+    def node_for(self, key):
+        i = bisect.bisect(self.points, ring_point(key)) % len(self.points)
+        return self.owners[i]
+
+
+def parse_shard(spec, members=None):
+    """
+    Returns (this node, all nodes) for `--shard i/N`, or for `--shard NAME`
+    with the membership list `members`.
+    """
+    if members:
+        nodes = [node.strip() for node in members.split(",") if node.strip()]
+        if spec not in nodes:
+            raise ValueError(f"shard {spec!r} is not one of the members {', '.join(nodes)}")
+        return spec, nodes
+    index, _, count = spec.partition("/")
+    if not (index.isdigit() and count.isdigit() and 1 <= int(index) <= int(count)):
+        raise ValueError(f"expected i/N with 1 <= i <= N (or a name with --shard-members), got {spec!r}")
+    return index, [str(i) for i in range(1, int(count) + 1)]
+
+
+def shard_devices(devices, node, nodes):
+    """The devices `node` owns."""
+    ring = HashRing(nodes)
+    return [device for device in devices if ring.node_for(device['host']) == node]
+
+
+def newest_entries(shard_dirs, hash_index):
+    """
+    {hostname: (shard dir, hash index entry)} over all shards. A device
+    found in more than one shard (after a membership change) is taken from
+    the shard that saw it last.
+    """
+    merged = {}
+    for shard_dir in shard_dirs:
+        path = os.path.join(shard_dir, hash_index)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            entries = json.load(f)
+        for hostname, entry in entries.items():
+            if hostname not in merged or entry.get('last_seen', "") > merged[hostname][1].get('last_seen', ""):
+                merged[hostname] = (shard_dir, entry)
+    return merged
+
+
+def latest_report(shard_dir, report_dir):
+    """The newest run report of a shard, or None."""
+    paths = sorted(glob.glob(os.path.join(shard_dir, report_dir, "run_*.json")))
+    if not paths:
+        return None
+    with open(paths[-1], 'r') as f:
+        report = json.load(f)
+    report['path'] = paths[-1]
+    return report
+
+
+def merge_records(reports):
+    """Device records of all shard reports; the newer report wins a duplicate host."""
+    records = {}
+    for report in sorted(reports, key=lambda report: report.get('started', "")):
+        for record in report.get('records', []):
+            records[record['host']] = record
+    return list(records.values())
@@ -0,0 +1,250 @@
+# Content-addressed snapshot store for config history.
+#
+# snapshots/
+#   objects/ab/cdef....z     compressed config, named by the SHA-256 of its text
+#   manifests/<host>.json    [{"time": "YYYYMMDD-HHMMSS", "sha256": ..., "normalized": ...}, ...]
+#                            oldest first
+#
+# Identical configs are stored once, and a manifest only grows when a
+# device's config actually differs from its previous snapshot. "Differs"
+# is judged on guardian's normalized hash when the caller passes one, so
+# volatile lines (RouterOS' export timestamp, IOS' last-change comment)
+# alone never add a snapshot; the object is still the raw text.
+
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import lzma
+import os
+import re
+import zlib
+from datetime import datetime, timedelta
+from threading import Lock
+
+import atomic_file
+
+SNAPSHOT_DIR = "snapshots"
+DATE_FORMAT = "%Y%m%d-%H%M%S"
+
+# Compression method -> (file extension, compress, decompress)
+CODECS = {
+    'zlib': ('.z', lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': ('.xz', lzma.compress, lzma.decompress),
+}
+
+# legacy temp/ files are named <hostname>_<YYYYMMDD-HHMMSS>.cfg
+LEGACY_NAME = re.compile(r"^(?P<host>.+)_(?P<time>\d{8}-\d{6})\.cfg$")
+
+logger = logging.getLogger("config_guardian")
+manifest_lock = Lock()
+
+
+def object_path(digest, root=SNAPSHOT_DIR):
+    return os.path.join(root, "objects", digest[:2], digest[2:])
+
+
+def manifest_path(hostname, root=SNAPSHOT_DIR):
+    return os.path.join(root, "manifests", f"{hostname}.json")
+
+
+def load_manifest(hostname, root=SNAPSHOT_DIR):
+    path = manifest_path(hostname, root)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(hostname, entries, root=SNAPSHOT_DIR):
+    atomic_file.atomic_write(manifest_path(hostname, root), json.dumps(entries, indent=1))
+
+
+def same_config(entry, digest, normalized):
+    if normalized and entry.get('normalized'):
+        return entry['normalized'] == normalized
+    return entry['sha256'] == digest
+
+
+def put(hostname, running_config, when=None, compression='zlib', root=SNAPSHOT_DIR,
+        normalized=None):
+    """
+    Store a snapshot of `running_config` for `hostname` taken at `when`
+    (a DATE_FORMAT string, default now) and return its content hash.
+    :param normalized: guardian's normalized hash of the config; a snapshot
+                       whose normalized hash matches the previous one is
+                       not stored again
+    """
+    when = when or datetime.now().strftime(DATE_FORMAT)
+    data = running_config.encode()
+    digest = hashlib.sha256(data).hexdigest()
+
+    with manifest_lock:
+        entries = load_manifest(hostname, root)
+    if entries and same_config(entries[-1], digest, normalized):
+        return entries[-1]['sha256']
+
+    # write the object once, whichever device or run produced it first
+    if not find_object(digest, root):
+        extension, compress, _ = CODECS[compression]
+        atomic_file.atomic_write(object_path(digest, root) + extension, compress(data), mode='wb')
+
+    entry = {'time': when, 'sha256': digest}
+    if normalized:
+        entry['normalized'] = normalized
+    with manifest_lock:
+        entries = load_manifest(hostname, root)
+        if entries and same_config(entries[-1], digest, normalized):
+            return entries[-1]['sha256']
+        entries.append(entry)
+        entries.sort(key=lambda entry: entry['time'])
+        save_manifest(hostname, entries, root)
+    logger.info("Saved snapshot of %s at %s (%s)", hostname, when, digest[:12])
+    return digest
+
+
+def find_object(digest, root=SNAPSHOT_DIR):
+    """Return the object file for `digest` whichever codec wrote it, or None."""
+    base = object_path(digest, root)
+    for extension, _, _ in CODECS.values():
+        if os.path.exists(base + extension):
+            return base + extension
+    return None
+
+
+def read_object(digest, root=SNAPSHOT_DIR):
+    path = find_object(digest, root)
+    if path is None:
+        raise KeyError(f"snapshot object {digest} not found")
+    for extension, _, decompress in CODECS.values():
+        if path.endswith(extension):
+            with open(path, 'rb') as f:
+                return decompress(f.read()).decode()
+
+
+def get(hostname, when=None, root=SNAPSHOT_DIR):
+    """
+    Return the config `hostname` had at time `when` (DATE_FORMAT string,
+    default latest), i.e. the newest snapshot taken at or before it.
+    Returns None when there is no snapshot that old.
+    """
+    entries = load_manifest(hostname, root)
+    if when is None:
+        position = len(entries)
+    else:
+        position = bisect.bisect_right([entry['time'] for entry in entries], when)
+    if position == 0:
+        return None
+    return read_object(entries[position - 1]['sha256'], root)
+
+
+def thin(entries, keep_recent, daily, weekly, now=None):
+    """
+    Pick which manifest entries a retention policy keeps: the `keep_recent`
+    newest, plus the newest snapshot of each of the last `daily` days and
+    `weekly` weeks.
+    """
+    now = now or datetime.now()
+    keep = set(range(max(0, len(entries) - keep_recent), len(entries)))
+    seen_days, seen_weeks = set(), set()
+
+    # walk newest first so the first hit in each bucket is the newest one
+    for position in reversed(range(len(entries))):
+        taken = datetime.strptime(entries[position]['time'], DATE_FORMAT)
+        day = taken.date()
+        week = tuple(taken.isocalendar()[:2])
+        if day not in seen_days and now - taken < timedelta(days=daily):
+            seen_days.add(day)
+            keep.add(position)
+        if week not in seen_weeks and now - taken < timedelta(weeks=weekly):
+            seen_weeks.add(week)
+            keep.add(position)
+    return [entries[position] for position in sorted(keep)]
+
+
+def prune(keep_recent=10, daily=7, weekly=8, root=SNAPSHOT_DIR):
+    """
+    Apply the retention policy to every manifest, then delete objects
+    no manifest refers to any more. Returns the number of objects removed.
+    """
+    manifests_dir = os.path.join(root, "manifests")
+    referenced = set()
+    with manifest_lock:
+        for name in os.listdir(manifests_dir) if os.path.isdir(manifests_dir) else []:
+            if not name.endswith(".json"):
+                continue
+            hostname = name[:-len(".json")]
+            entries = thin(load_manifest(hostname, root), keep_recent, daily, weekly)
+            save_manifest(hostname, entries, root)
+            referenced.update(entry['sha256'] for entry in entries)
+
+    removed = 0
+    objects_dir = os.path.join(root, "objects")
+    for dirpath, _, filenames in os.walk(objects_dir):
+        for filename in filenames:
+            digest = os.path.basename(dirpath) + filename.split('.')[0]
+            if digest not in referenced:
+                os.remove(os.path.join(dirpath, filename))
+                removed += 1
+    logger.info("Pruned %d unreferenced snapshot objects", removed)
+    return removed
+
+
+def import_legacy(temp_dir, compression='zlib', root=SNAPSHOT_DIR):
+    """
+    Load old temp/<host>_<timestamp>.cfg files into the store.
+    Returns the number of files imported; the originals are left in place.
+    """
+    imported = 0
+    for filename in sorted(os.listdir(temp_dir)):
+        match = LEGACY_NAME.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(temp_dir, filename), 'r') as f:
+            put(match['host'], f.read(), when=match['time'], compression=compression, root=root)
+        imported += 1
+    return imported
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Config guardian snapshot store.")
+    parser.add_argument("--root", default=SNAPSHOT_DIR, help="Snapshot store directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    show = sub.add_parser("get", help="Print a device config as it was at a point in time.")
+    show.add_argument("hostname")
+    show.add_argument("--at", help="Time as YYYYMMDD-HHMMSS (default: latest)")
+
+    history = sub.add_parser("history", help="List the snapshots kept for a device.")
+    history.add_argument("hostname")
+
+    retention = sub.add_parser("prune", help="Apply the retention policy and drop unused objects.")
+    retention.add_argument("--keep", type=int, default=10, help="Newest snapshots to keep (default: 10)")
+    retention.add_argument("--daily", type=int, default=7, help="Days to keep one per day (default: 7)")
+    retention.add_argument("--weekly", type=int, default=8, help="Weeks to keep one per week (default: 8)")
+
+    legacy = sub.add_parser("import", help="Import legacy temp/ snapshot files.")
+    legacy.add_argument("temp_dir", nargs="?", default="temp")
+    legacy.add_argument("--compression", choices=CODECS, default='zlib')
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parse_args()
+
+    if args.command == "get":
+        config = get(args.hostname, args.at, root=args.root)
+        if config is None:
+            raise SystemExit(f"No snapshot of {args.hostname} at or before {args.at or 'now'}")
+        print(config, end='')
+    elif args.command == "history":
+        for entry in load_manifest(args.hostname, root=args.root):
+            print(entry['time'], entry['sha256'])
+    elif args.command == "prune":
+        prune(args.keep, args.daily, args.weekly, root=args.root)
+    elif args.command == "import":
+        count = import_legacy(args.temp_dir, args.compression, root=args.root)
+        print(f"Imported {count} snapshots from {args.temp_dir}")
@@ -0,0 +1,132 @@
+# Syslog receiver that turns config-change messages into backup triggers.
+#
+# Listens on UDP and TCP (newline or octet-counted framing), spots the
+# vendors' "configuration changed" messages, maps the sender to an
+# inventory device and calls on_change(device) once the burst of
+# messages for that device has gone quiet (debouncing).
+
+import asyncio
+import logging
+import re
+from threading import Thread
+
+logger = logging.getLogger("config_guardian")
+
+# Cisco %SYS-5-CONFIG_I, Huawei CFGCHANGE / CFG_CHANGE, Junos UI_COMMIT
+# (but not UI_COMMIT_PROGRESS and friends)
+CONFIG_CHANGE = re.compile(rb"%SYS-5-CONFIG_I\b|CFG_?CHANGE|\bUI_COMMIT\b")
+
+# RFC 3164: "<PRI>Mmm dd hh:mm:ss HOSTNAME ..." / RFC 5424: "<PRI>1 TIMESTAMP HOSTNAME ..."
+RFC3164_HOST = re.compile(rb"^<\d+>\w{3} +\d+ [\d:]+ (\S+) ")
+RFC5424_HOST = re.compile(rb"^<\d+>\d+ \S+ (\S+) ")
+
+MAX_DELAY_FACTOR = 6  # a device is backed up at the latest this many debounce windows after its first change
+
+
+def syslog_hostname(message):
+    match = RFC3164_HOST.match(message) or RFC5424_HOST.match(message)
+    return match.group(1).decode(errors="replace") if match else None
+
+
+class SyslogListener:
+    """
+    :param lookup: lookup(source_ip, syslog_hostname) -> device or None
+    :param on_change: called with the device once its changes settle
+    :param debounce: seconds of quiet to wait after the last change message
+    """
+
+    def __init__(self, lookup, on_change, debounce=5.0):
+        self.lookup = lookup
+        self.on_change = on_change
+        self.debounce = debounce
+        self.pending = {}  # host -> (timer handle, first seen)
+        self.loop = None
+
+    def handle(self, message, source_ip):
+        if not CONFIG_CHANGE.search(message):
+            return
+        device = self.lookup(source_ip, syslog_hostname(message))
+        if device is None:
+            logger.debug("Config change from unknown source %s ignored", source_ip)
+            return
+
+        host = device['host']
+        now = self.loop.time()
+        timer, first_seen = self.pending.get(host, (None, now))
+        if timer:
+            timer.cancel()
+        # trailing debounce, but never hold a busy device back forever
+        fire_at = min(now + self.debounce, first_seen + self.debounce * MAX_DELAY_FACTOR)
+        if timer is None:
+            logger.info("Config change reported by %s, backup queued", host)
+        timer = self.loop.call_at(fire_at, self.fire, device)
+        self.pending[host] = (timer, first_seen)
+
+    def fire(self, device):
+        self.pending.pop(device['host'], None)
+        try:
+            self.on_change(device)
+        except Exception:
+            logger.exception("[syslog] on_change failed for %s", device['host'])
+
+    async def handle_tcp(self, reader, writer):
+        source_ip = writer.get_extra_info('peername')[0]
+        buffer = b""
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buffer += data
+                buffer = self.split_frames(buffer, source_ip)
+        finally:
+            writer.close()
+
+    def split_frames(self, buffer, source_ip):
+        """Handle every complete frame in buffer and return the leftover bytes."""
+        while buffer:
+            counted = re.match(rb"(\d+) ", buffer)
+            if counted:
+                # octet counting (RFC 6587): "<length> <message>"
+                end = counted.end() + int(counted.group(1))
+                if len(buffer) < end:
+                    break
+                message, buffer = buffer[counted.end():end], buffer[end:]
+            else:
+                newline = buffer.find(b"\n")
+                if newline < 0:
+                    break
+                message, buffer = buffer[:newline], buffer[newline + 1:]
+            self.handle(message.strip(), source_ip)
+        return buffer
+
+    async def serve(self, bind, port):
+        self.loop = asyncio.get_running_loop()
+        listener = self
+
+        class UdpProtocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                listener.handle(data.strip(), addr[0])
+
+        transport, _ = await self.loop.create_datagram_endpoint(UdpProtocol, local_addr=(bind, port))
+        server = await asyncio.start_server(self.handle_tcp, bind, port)
+        logger.info("Listening for syslog on %s:%d (udp+tcp)", bind, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            transport.close()
+
+
+def start_in_thread(bind, port, lookup, on_change, debounce=5.0):
+    """Run a SyslogListener on its own event loop in a daemon thread."""
+    listener = SyslogListener(lookup, on_change, debounce)
+
+    def run():
+        try:
+            asyncio.run(listener.serve(bind, port))
+        except Exception:
+            logger.exception("[syslog] listener stopped")
+
+    Thread(target=run, name="syslog-listener", daemon=True).start()
+    return listener